@@ -0,0 +1,1058 @@
+import hashlib
+import importlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from time import perf_counter, sleep, time
+
+import requests
+from werkzeug.test import EnvironBuilder
+
+import Blocky
+from Blocky import (BINARY_MIMETYPE, Block, Blockchain, BlockStore, Counter, Histogram, Ledger, Transaction,
+                    WorkerPool, check_proofs, check_signatures, encode_frames, find_proof, generate_key, hash_block,
+                    parallel_proof_of_work, proof_target, verify_proofs, verify_signatures)
+
+# The other implementations in this repository, which still hash hex digests
+SCRIPTS = ['Blockchain', 'BlockchainAttempt1', 'BlockchainAttempt2']
+
+
+# Registered benchmarks, in the order they run
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, *args):
+    """
+    Run a function once
+    :return: <tuple> (seconds taken, return value)
+    """
+
+    start = perf_counter()
+    result = func(*args)
+    return perf_counter() - start, result
+
+
+def build_chain(blocks, transactions=0, **options):
+    """
+    A Blockchain of the given length, mined at the lowest difficulty
+    :param blocks: <int> Number of blocks after the genesis block
+    :param transactions: <int> Transactions in each block
+    :param options: More arguments for the Blockchain
+    """
+
+    blockchain = Blockchain(**{'mining_workers': 1, 'difficulty': 1, 'retarget_interval': blocks + 2, **options})
+    for _ in range(blocks):
+        for n in range(transactions):
+            blockchain.new_transaction(sender=f'sender-{n}', recipient=f'recipient-{n}', amount=n + 1)
+        last_block = blockchain.last_block
+        proof = blockchain.proof_of_work(last_block, 1)
+        blockchain.new_block(proof, blockchain.hash(last_block), 1)
+
+    return blockchain
+
+
+def hexdigest_search(last_proof, last_hash, stop, prefix):
+    # The nonce search as it was before find_proof: a new f-string and hexdigest per guess
+    for proof in range(stop):
+        guess = f'{last_proof}{proof}{last_hash}'.encode()
+        if hashlib.sha256(guess).hexdigest()[:4] == prefix:
+            return proof
+
+    return None
+
+
+@benchmark
+def hash_rate(nonces=500000):
+    """
+    Hashes per second of the nonce search, before and after the fast path
+    """
+
+    # Targets nothing will meet, so both loops scan every nonce
+    last_proof, last_hash = 100, 'f' * 64
+    hexdigest_seconds, _ = timed(hexdigest_search, last_proof, last_hash, nonces, 'xxxx')
+    fast_seconds, _ = timed(find_proof, last_proof, last_hash, 0, nonces, None, bytes(32))
+
+    return {
+        'nonces': nonces,
+        'hexdigest_hashes_per_second': nonces / hexdigest_seconds,
+        'digest_hashes_per_second': nonces / fast_seconds,
+    }
+
+
+@benchmark
+def block_hash_cache(blocks=100000, mines=20):
+    """
+    valid_chain over a chain of plain dicts, which hashes every block, against the
+    same chain of sealed blocks, and the time /mine spends hashing the last block
+    """
+
+    blockchain = build_chain(blocks)
+    plain_chain = [block.to_dict() for block in blockchain.chain]
+    plain_seconds, plain_valid = timed(blockchain.valid_chain, plain_chain)
+    sealed_seconds, sealed_valid = timed(blockchain.valid_chain, blockchain.chain)
+    assert plain_valid and sealed_valid
+
+    last_block = blockchain.last_block
+    rehash_seconds, _ = timed(lambda: [hash_block(last_block) for _ in range(mines)])
+    cached_seconds, _ = timed(lambda: [blockchain.hash(last_block) for _ in range(mines)])
+
+    Blocky.blockchain = blockchain
+    client = Blocky.app.test_client()
+    mine_seconds, _ = timed(lambda: [client.get('/mine') for _ in range(mines)])
+
+    return {
+        'blocks': blocks,
+        'valid_chain_plain_seconds': plain_seconds,
+        'valid_chain_sealed_seconds': sealed_seconds,
+        'last_block_rehash_seconds': rehash_seconds / mines,
+        'last_block_cached_seconds': cached_seconds / mines,
+        'mine_seconds': mine_seconds / mines,
+    }
+
+
+@benchmark
+def transaction_submission(transactions=5000, batch_size=500):
+    """
+    Requests and transactions per second through /transactions/new, one at a time,
+    against /transactions/batch as JSON arrays and as NDJSON
+    """
+
+    entries = [
+        {'sender': f'sender-{n}', 'recipient': f'recipient-{n}', 'amount': n + 1}
+        for n in range(transactions)
+    ]
+    batches = [entries[start:start + batch_size] for start in range(0, transactions, batch_size)]
+    client = Blocky.app.test_client()
+    results = {'transactions': transactions, 'batch_size': batch_size}
+
+    def submit(name, requests):
+        Blocky.blockchain = Blockchain(mining_workers=1)
+        seconds, _ = timed(lambda: [client.post(*args, **kwargs) for args, kwargs in requests])
+        assert len(Blocky.blockchain.mempool) == transactions
+        results[f'{name}_requests_per_second'] = len(requests) / seconds
+        results[f'{name}_transactions_per_second'] = transactions / seconds
+
+    submit('single', [(('/transactions/new',), {'json': entry}) for entry in entries])
+    submit('batch', [(('/transactions/batch',), {'json': entries}) for entries in batches])
+    submit('ndjson', [
+        (('/transactions/batch',), {
+            'data': ''.join(json.dumps(entry) + '\n' for entry in entries),
+            'content_type': 'application/x-ndjson',
+        })
+        for entries in batches
+    ])
+
+    return results
+
+
+@benchmark
+def proof_verification(blocks=100000):
+    """
+    Proofs per second checked one valid_proof call at a time, in one batch with and
+    without NumPy, and in batches across a pool with a process per CPU, along with
+    how long valid_chain takes over the whole chain
+    """
+
+    blockchain = build_chain(blocks)
+    chain = blockchain.chain
+    proofs = [
+        (chain[n - 1].proof, chain[n].proof, chain[n - 1].hash, chain[n].difficulty)
+        for n in range(1, len(chain))
+    ]
+    workers = os.cpu_count() or 1
+
+    serial_seconds, serial = timed(lambda: [Blockchain.valid_proof(*proof) for proof in proofs])
+    batch_seconds, batch = timed(check_proofs, proofs)
+    numpy, Blocky.numpy = Blocky.numpy, None
+    try:
+        plain_seconds, plain = timed(check_proofs, proofs)
+    finally:
+        Blocky.numpy = numpy
+    pool_seconds, pooled = timed(verify_proofs, proofs, workers)
+    assert serial == batch == plain == pooled and all(serial)
+
+    blockchain.mining_workers = workers
+    blockchain.pool = WorkerPool(workers)
+    try:
+        shared_seconds, shared = timed(verify_proofs, proofs, workers, Blocky.VERIFY_CHUNK_SIZE, blockchain.pool)
+        chain_seconds, valid = timed(blockchain.valid_chain, chain)
+    finally:
+        blockchain.pool.close()
+    assert shared == serial and valid
+
+    return {
+        'proofs': len(proofs),
+        'workers': workers,
+        'numpy': numpy is not None,
+        'serial_proofs_per_second': len(proofs) / serial_seconds,
+        'batch_proofs_per_second': len(proofs) / batch_seconds,
+        'batch_without_numpy_proofs_per_second': len(proofs) / plain_seconds,
+        'pool_proofs_per_second': len(proofs) / pool_seconds,
+        'shared_pool_proofs_per_second': len(proofs) / shared_seconds,
+        'valid_chain_blocks_per_second': len(proofs) / chain_seconds,
+    }
+
+
+@benchmark
+def encoding_throughput(blocks=1000, transactions=50):
+    """
+    Blocks per second encoded, decoded and hashed as sorted-key JSON against the
+    binary encoding, transaction ids per second each way, and the bytes each takes
+    """
+
+    blockchain = build_chain(blocks, transactions)
+    chain = blockchain.chain
+    everything = [transaction for block in chain for transaction in block.transactions]
+
+    json_encode_seconds, documents = timed(lambda: [json.dumps(block.to_dict(), sort_keys=True).encode() for block in chain])
+    binary_encode_seconds, records = timed(lambda: [block.encode() for block in chain])
+
+    # Decoding an untrusted block also works out its transaction ids and Merkle root again
+    json_decode_seconds, _ = timed(lambda: [Block.from_dict(json.loads(document)) for document in documents])
+    binary_decode_seconds, _ = timed(lambda: [Block.decode(record) for record in records])
+
+    json_hash_seconds, _ = timed(lambda: [
+        hashlib.sha256(json.dumps(block.header(), sort_keys=True).encode()).hexdigest() for block in chain
+    ])
+    binary_hash_seconds, _ = timed(lambda: [hash_block(block) for block in chain])
+
+    json_txid_seconds, _ = timed(lambda: [
+        hashlib.sha256(json.dumps(transaction.to_dict(), sort_keys=True).encode()).hexdigest()
+        for transaction in everything
+    ])
+    binary_txid_seconds, _ = timed(lambda: [transaction.id for transaction in everything])
+
+    return {
+        'blocks': len(chain),
+        'transactions': len(everything),
+        'json_encode_blocks_per_second': len(chain) / json_encode_seconds,
+        'binary_encode_blocks_per_second': len(chain) / binary_encode_seconds,
+        'json_decode_blocks_per_second': len(chain) / json_decode_seconds,
+        'binary_decode_blocks_per_second': len(chain) / binary_decode_seconds,
+        'json_hash_blocks_per_second': len(chain) / json_hash_seconds,
+        'binary_hash_blocks_per_second': len(chain) / binary_hash_seconds,
+        'json_txids_per_second': len(everything) / json_txid_seconds,
+        'binary_txids_per_second': len(everything) / binary_txid_seconds,
+        'json_bytes': sum(map(len, documents)),
+        'binary_bytes': sum(map(len, records)),
+    }
+
+
+def traced_size(build):
+    """
+    Bytes still allocated by build() once it returns, along with what it built
+    """
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        built = build()
+        return tracemalloc.get_traced_memory()[0] - before, built
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark
+def chain_memory(blocks=10000, transactions=50):
+    """
+    Memory held by a chain as plain dicts against the same chain as Block and Transaction objects
+    """
+
+    blockchain = build_chain(blocks, transactions)
+    dict_bytes, plain_chain = traced_size(lambda: [block.to_dict() for block in blockchain.chain])
+    slots_bytes, _ = traced_size(lambda: [Block.from_dict(block) for block in plain_chain])
+
+    return {
+        'blocks': blocks,
+        'transactions': blocks * transactions,
+        'dict_bytes': dict_bytes,
+        'slots_bytes': slots_bytes,
+    }
+
+
+@benchmark
+def pruned_memory(blocks=4000, transactions=50, prune_depth=200):
+    """
+    Memory held by a chain that keeps every block against one that prunes, after
+    half the blocks and after all of them; a pruned chain's should stay about the same
+    """
+
+    results = {'blocks': blocks, 'transactions': blocks * transactions, 'prune_depth': prune_depth}
+    for label, options in [('full', {}), ('pruned', {'prune_depth': prune_depth, 'retarget_interval': 10})]:
+        for stage, length in [('halfway', blocks // 2), ('end', blocks)]:
+            held, _ = traced_size(lambda: build_chain(length, transactions, **options))
+            results[f'{label}_{stage}_bytes'] = held
+
+    return results
+
+
+def percentile(samples, fraction):
+    """
+    The sample below which the given fraction of samples fall
+    :param samples: <list> Sorted samples
+    :param fraction: <float> Between 0 and 1
+    """
+
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def start_node(server, port, *options):
+    """
+    Run Blocky.py in its own process and wait until it answers
+    :param server: <str> 'flask' or 'asgi'
+    :param port: <int>
+    :param options: <str> More command line options
+    :return: <Popen>
+    """
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Blocky.py')
+    node = subprocess.Popen(
+        [sys.executable, script, '--server', server, '--port', str(port), '--difficulty', '1', '--workers', '1',
+         *options],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/chain/head', timeout=1)
+            return node
+        except requests.ConnectionError:
+            sleep(0.1)
+
+    node.kill()
+    raise RuntimeError(f'{server} node did not start on port {port}')
+
+
+@benchmark
+def server_latency(clients=(1, 10, 100), requests_per_client=20, blocks=20, transactions=200, port=5100):
+    """
+    p50 and p99 request latency of Flask's development server against the asgi
+    server, with each client alternating between reading /chain and submitting
+    a transaction
+    """
+
+    results = {'requests_per_client': requests_per_client, 'blocks': blocks}
+
+    for offset, server in enumerate(['flask', 'asgi']):
+        url = f'http://127.0.0.1:{port + offset}'
+        node = start_node(server, port + offset)
+        try:
+            # Give /chain something to serialize
+            for block in range(blocks):
+                requests.post(f'{url}/transactions/batch', json=[
+                    {'sender': f'sender-{n}', 'recipient': f'recipient-{block}', 'amount': n + 1}
+                    for n in range(transactions)
+                ])
+                requests.get(f'{url}/mine')
+
+            def client(number):
+                latencies = []
+                with requests.Session() as session:
+                    for n in range(requests_per_client):
+                        start = perf_counter()
+                        if n % 2:
+                            session.post(f'{url}/transactions/new', json={
+                                'sender': f'client-{number}', 'recipient': 'node', 'amount': n + 1,
+                            }).raise_for_status()
+                        else:
+                            session.get(f'{url}/chain').raise_for_status()
+                        latencies.append(perf_counter() - start)
+                return latencies
+
+            for concurrency in clients:
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    latencies = sorted(sum(pool.map(client, range(concurrency)), []))
+                results[f'{server}_{concurrency}_p50_seconds'] = percentile(latencies, 0.5)
+                results[f'{server}_{concurrency}_p99_seconds'] = percentile(latencies, 0.99)
+        finally:
+            node.terminate()
+            node.wait()
+
+    return results
+
+
+def wait_for(condition, timeout=60):
+    """
+    Poll until condition() is true
+    :return: <float> Seconds it took
+    """
+
+    start = perf_counter()
+    while not condition():
+        if perf_counter() - start > timeout:
+            raise RuntimeError('Timed out')
+        sleep(0.01)
+
+    return perf_counter() - start
+
+
+@benchmark
+def gossip_propagation(nodes=8, peers=2, lengths=(10, 200), new_blocks=5, transactions=100, port=5200):
+    """
+    Time and gossip traffic for new blocks and transactions to reach every node of a
+    network, once the network agrees on a chain of each length. Every node is
+    peered with the peers nodes either side of it in a ring.
+    """
+
+    results = {'nodes': nodes, 'new_blocks': new_blocks, 'transactions': transactions}
+
+    for length in lengths:
+        urls = [f'http://127.0.0.1:{port + n}' for n in range(nodes)]
+        processes = [start_node('flask', port + n, '--retarget-interval', str(10 ** 9)) for n in range(nodes)]
+        try:
+            for n, url in enumerate(urls):
+                neighbours = [urls[(n + step) % nodes] for step in range(-peers, peers + 1) if step]
+                requests.post(f'{url}/nodes/register', json={'nodes': neighbours})
+
+            def agreed():
+                heads = [requests.get(f'{url}/chain/head').json() for url in urls]
+                return len({head['hash'] for head in heads}) == 1 and heads[0]['length'] == length + extra
+
+            def traffic():
+                statuses = [requests.get(f'{url}/gossip/status').json() for url in urls]
+                return sum(status['bytes_sent'] + status['bytes_received'] for status in statuses)
+
+            # Build the chain on the first node and let it spread
+            extra = 1
+            for _ in range(length):
+                requests.get(f'{urls[0]}/mine')
+            wait_for(agreed)
+
+            before = traffic()
+            extra = new_blocks + 1
+            block_seconds = -perf_counter()
+            for _ in range(new_blocks):
+                requests.get(f'{urls[0]}/mine')
+            wait_for(agreed)
+            block_seconds += perf_counter()
+            block_bytes = traffic() - before
+
+            before = traffic()
+            requests.post(f'{urls[-1]}/transactions/batch', json=[
+                {'sender': f'sender-{n}', 'recipient': 'recipient', 'amount': n + 1} for n in range(transactions)
+            ])
+            txid = requests.post(f'{urls[-1]}/transactions/new', json={
+                'sender': 'last', 'recipient': 'recipient', 'amount': 1,
+            }).json()['id']
+            transaction_seconds = wait_for(lambda: all(
+                requests.get(f'{url}/transactions/{txid}').status_code == 200 for url in urls
+            ))
+            transaction_bytes = traffic() - before
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+        results[f'length_{length}_block_seconds'] = block_seconds
+        results[f'length_{length}_bytes_per_block'] = block_bytes / new_blocks
+        results[f'length_{length}_transaction_seconds'] = transaction_seconds
+        results[f'length_{length}_bytes_per_transaction'] = transaction_bytes / (transactions + 1)
+
+    return results
+
+
+def fork_blocks(parent, blocks, label):
+    """
+    Blocks mined at the lowest difficulty on top of parent, each holding one transaction of its own
+    :param parent: <Block> Block the fork starts from
+    :param blocks: <int> Number of blocks
+    :param label: <str> Makes the fork's transactions unique
+    """
+
+    fork = []
+    for n in range(blocks):
+        proof = find_proof(parent.proof, parent.hash, target=proof_target(1))
+        transaction = Transaction(sender='0', recipient=f'{label}-{n}', amount=1)
+        parent = Block(parent.index + 1, time(), [transaction], proof, parent.hash, 1)
+        fork.append(parent)
+
+    return fork
+
+
+@benchmark
+def concurrency_stress(seconds=5, submitters=8, readers=4):
+    """
+    Submitters, a miner, readers and chain reorganisations all hitting one Blockchain
+    at once. Fails unless every read saw a linked chain and every submitted
+    transaction ended up mined or waiting, including the ones whose block a
+    reorganisation dropped.
+    """
+
+    blockchain = Blockchain(mining_workers=1, difficulty=1, retarget_interval=10 ** 9)
+    Blocky.blockchain = blockchain
+    stopping = threading.Event()
+    submitted = [[] for _ in range(submitters)]
+    dropped = []
+    reads = []
+    bad_reads = []
+
+    def submit(number):
+        client = Blocky.app.test_client()
+        for n in count():
+            if stopping.is_set():
+                return
+            if n % 2:
+                response = client.post('/transactions/new', json={
+                    'sender': f'sender-{number}', 'recipient': 'recipient', 'amount': n + 1,
+                })
+                submitted[number].append(response.get_json()['id'])
+            else:
+                response = client.post('/transactions/batch', json=[
+                    {'sender': f'sender-{number}', 'recipient': f'batch-{m}', 'amount': n + 1} for m in range(10)
+                ])
+                submitted[number].extend(result['id'] for result in response.get_json()['results'])
+
+    def mine():
+        while not stopping.is_set():
+            blockchain.mine('miner')
+
+    def read():
+        client = Blocky.app.test_client()
+        while not stopping.is_set():
+            body = client.get('/chain').get_json()
+            chain = [Block.from_dict(block) for block in body['chain']]
+            linked = all(chain[n].previous_hash == chain[n - 1].hash for n in range(1, len(chain)))
+            reads.append(len(chain))
+            if len(chain) != body['length'] or not linked:
+                bad_reads.append(body['length'])
+
+    def reorganise():
+        for n in count():
+            if stopping.is_set():
+                return
+            chain, length, _ = blockchain.head
+            shared = max(1, length - 2)
+            new_chain = chain[:shared] + fork_blocks(chain[shared - 1], length - shared + 5, f'fork-{n}')
+            blocks = blockchain.replace_chain(new_chain, blockchain.chain_work(new_chain), shared)
+            if blocks is not None:
+                dropped.extend(blocks)
+            sleep(0.05)
+
+    # Blocks come so much faster here than on a network that transactions a reorganisation
+    # put back would fall out of the transaction window before they were mined again
+    window, Blocky.TRANSACTION_WINDOW = Blocky.TRANSACTION_WINDOW, 10 ** 9
+    threads = [threading.Thread(target=submit, args=(number,)) for number in range(submitters)]
+    threads += [threading.Thread(target=read) for _ in range(readers)]
+    threads += [threading.Thread(target=mine), threading.Thread(target=reorganise)]
+    try:
+        for thread in threads:
+            thread.start()
+        sleep(seconds)
+    finally:
+        stopping.set()
+        for thread in threads:
+            thread.join()
+        Blocky.TRANSACTION_WINDOW = window
+
+    # Nothing lost, nothing waiting to be mined a second time
+    ledger = blockchain.ledger.transactions
+    all_submitted = [txid for ids in submitted for txid in ids]
+    lost = [txid for txid in all_submitted if txid not in ledger and txid not in blockchain.mempool]
+    mined_twice = [txid for txid in blockchain.mempool.transactions if txid in ledger]
+
+    # The indexes match the chain they describe
+    rebuilt = Ledger()
+    for position, block in enumerate(blockchain.chain):
+        rebuilt.add_block(block, position)
+    assert rebuilt.transactions == ledger and rebuilt.balances == blockchain.ledger.balances
+    assert not lost and not mined_twice and not bad_reads
+
+    return {
+        'seconds': seconds,
+        'transactions_submitted': len(all_submitted),
+        'blocks': len(blockchain.chain),
+        'blocks_dropped': len(dropped),
+        'chain_reads': len(reads),
+        'lost_transactions': len(lost),
+        'inconsistent_reads': len(bad_reads),
+    }
+
+
+@benchmark
+def reorg_latency(length=5000, transactions=20, depths=(1, 10, 100)):
+    """
+    Seconds replace_chain takes to reorganise onto a fork of each depth, rolling the
+    indexes back and forward, against rebuilding the indexes over the whole chain
+    """
+
+    blockchain = build_chain(length, transactions)
+    results = {'length': length, 'transactions': length * transactions}
+
+    for depth in depths:
+        chain, chain_length, _ = blockchain.head
+        shared = chain_length - depth
+        new_chain = chain[:shared] + fork_blocks(chain[shared - 1], depth + 1, f'fork-{depth}')
+        seconds, dropped = timed(blockchain.replace_chain, new_chain, blockchain.chain_work(new_chain), shared)
+        assert len(dropped) == depth
+        results[f'depth_{depth}_seconds'] = seconds
+
+    def rebuild():
+        ledger = Ledger()
+        for position, block in enumerate(blockchain.chain):
+            ledger.add_block(block, position)
+    results['rebuild_seconds'], _ = timed(rebuild)
+
+    return results
+
+
+@benchmark
+def valid_proof_rate(guesses=200000):
+    """
+    valid_proof calls per second in Blocky.py and in each of the other scripts
+    """
+
+    results = {'guesses': guesses}
+
+    last_hash = hashlib.sha256(b'0').hexdigest()
+    valid_proof = Blockchain.valid_proof
+    seconds, _ = timed(lambda: [valid_proof(100, proof, last_hash, 16) for proof in range(guesses)])
+    results['Blocky_hashes_per_second'] = guesses / seconds
+
+    for script in SCRIPTS:
+        valid_proof = importlib.import_module(script).Blockchain.valid_proof
+        seconds, _ = timed(lambda: [valid_proof(100, proof) for proof in range(guesses)])
+        results[f'{script}_hashes_per_second'] = guesses / seconds
+
+    return results
+
+
+@benchmark
+def mining_time(difficulties=(8, 12, 16), blocks=5):
+    """
+    Mean seconds to mine a block at each difficulty, in leading zero bits, with
+    Blocky.py's search, across processes started for each block and across processes
+    kept between blocks, and with the other scripts' hex digit check. The blocks
+    mined are the same on every run, so the number of hashes is too.
+    """
+
+    workers = max(os.cpu_count() or 1, 2)
+    results = {'blocks': blocks, 'workers': workers}
+    pool = WorkerPool(workers)
+
+    for difficulty in difficulties:
+        jobs = [(n, hashlib.sha256(str(n).encode()).hexdigest()) for n in range(blocks)]
+
+        target = proof_target(difficulty)
+        seconds, proofs = timed(lambda: [find_proof(last_proof, last_hash, target=target) for last_proof, last_hash in jobs])
+        results[f'Blocky_{difficulty}_seconds'] = seconds / blocks
+        results[f'Blocky_{difficulty}_hashes'] = sum(proofs) + blocks
+
+        seconds, fresh = timed(lambda: [parallel_proof_of_work(last_proof, last_hash, workers, target=target)
+                                        for last_proof, last_hash in jobs])
+        results[f'fresh_pool_{difficulty}_seconds'] = seconds / blocks
+        seconds, shared = timed(lambda: [parallel_proof_of_work(last_proof, last_hash, workers, target=target, pool=pool)
+                                         for last_proof, last_hash in jobs])
+        results[f'shared_pool_{difficulty}_seconds'] = seconds / blocks
+        assert fresh == shared == proofs
+
+        # The scripts count difficulty in hex digits, four bits each
+        if difficulty % 4 == 0:
+            for script in SCRIPTS:
+                valid_proof = importlib.import_module(script).Blockchain.valid_proof
+
+                def mine(last_proof):
+                    proof = 0
+                    while valid_proof(last_proof, proof, difficulty // 4) is False:
+                        proof += 1
+                    return proof
+
+                # Their puzzle leaves out the last hash, so count the hashes it took as well
+                seconds, proofs = timed(lambda: [mine(last_proof) for last_proof, _ in jobs])
+                results[f'{script}_{difficulty}_seconds'] = seconds / blocks
+                results[f'{script}_{difficulty}_hashes'] = sum(proofs) + blocks
+
+    pool.close()
+    return results
+
+
+@benchmark
+def block_hash_throughput(sizes=(0, 10, 100, 1000), blocks=200):
+    """
+    Blocks per second through Blockchain.hash for blocks of each number of
+    transactions, given as plain dicts the way peers send them, against hashing
+    only a sealed block's header and against the scripts' hash of the whole block's JSON
+    """
+
+    results = {'blocks': blocks}
+
+    for size in sizes:
+        transactions = [Transaction(f'sender-{n}', f'recipient-{n}', n, float(n)) for n in range(size)]
+        sealed = [Block(n + 2, float(n), transactions, n, '0' * 64, 1) for n in range(blocks)]
+        plain = [block.to_dict() for block in sealed]
+
+        seconds, _ = timed(lambda: [Blockchain.hash(block) for block in plain])
+        results[f'{size}_transactions_plain_blocks_per_second'] = blocks / seconds
+
+        seconds, _ = timed(lambda: [hash_block(block) for block in sealed])
+        results[f'{size}_transactions_header_blocks_per_second'] = blocks / seconds
+
+        json_hash = importlib.import_module(SCRIPTS[0]).Blockchain.hash
+        seconds, _ = timed(lambda: [json_hash(block) for block in plain])
+        results[f'{size}_transactions_json_blocks_per_second'] = blocks / seconds
+
+    return results
+
+
+@benchmark
+def valid_chain_scaling(lengths=(1000, 10000, 100000)):
+    """
+    Seconds valid_chain takes by chain length, over sealed blocks and over the
+    plain dicts a peer's chain arrives as
+    """
+
+    blockchain = build_chain(max(lengths) - 1)
+    blockchain.mining_workers = os.cpu_count() or 1
+    blockchain.pool = WorkerPool(blockchain.mining_workers)
+    results = {'workers': blockchain.mining_workers}
+
+    try:
+        for length in lengths:
+            sealed = blockchain.chain[:length]
+            plain = [block.to_dict() for block in sealed]
+
+            seconds, valid = timed(blockchain.valid_chain, sealed)
+            assert valid
+            results[f'{length}_sealed_seconds'] = seconds
+
+            seconds, valid = timed(blockchain.valid_chain, plain)
+            assert valid
+            results[f'{length}_plain_seconds'] = seconds
+    finally:
+        blockchain.pool.close()
+
+    return results
+
+
+def traced_peak(func):
+    """
+    Run func() and measure the most memory it held at once
+    :return: <tuple> (peak bytes allocated, return value)
+    """
+
+    tracemalloc.start()
+    try:
+        result = func()
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+
+def drain(path, headers=None):
+    """
+    Call the node's WSGI app directly and read the response through, keeping none of it
+    :return: <int> Bytes in the response
+    """
+
+    environ = EnvironBuilder(path=path, headers=headers).get_environ()
+    body = Blocky.app(environ, lambda status, headers, exc_info=None: None)
+    try:
+        return sum(len(chunk) for chunk in body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+@benchmark
+def chain_serialization(lengths=(1000, 10000), transactions=10):
+    """
+    Seconds and peak memory for /chain to serialize the whole chain by length,
+    as one JSON document, streamed JSON, NDJSON and binary
+    """
+
+    blockchain = build_chain(max(lengths) - 1, transactions)
+    results = {'transactions': transactions}
+    formats = {
+        'json': ('/chain', None),
+        'stream_json': ('/chain?stream=json', None),
+        'ndjson': ('/chain?stream=ndjson', None),
+        'binary': ('/chain', {'Accept': BINARY_MIMETYPE}),
+    }
+
+    for length in lengths:
+        Blocky.blockchain = Blockchain(mining_workers=1, difficulty=1)
+        Blocky.blockchain.chain = blockchain.chain[:length]
+        Blocky.blockchain.publish()
+
+        for name, (path, headers) in formats.items():
+            # Tracing allocations slows everything down, so the time comes from a run of its own
+            seconds, size = timed(drain, path, headers)
+            peak, _ = traced_peak(lambda: drain(path, headers))
+            results[f'{length}_{name}_seconds'] = seconds
+            results[f'{length}_{name}_peak_bytes'] = peak
+            results[f'{length}_{name}_response_bytes'] = size
+
+    return results
+
+
+@benchmark
+def resolve_latency(length=2000, new_blocks=10, peers=(1, 4, 8), port=5300):
+    """
+    Seconds resolve_conflicts takes against local stand-in peers, by number of
+    peers, when we are new_blocks behind them and when we hold only their genesis block.
+    Each peer is a Blocky.py process serving a copy of the same stored chain.
+    """
+
+    interval = str(length + new_blocks + 2)
+    blockchain = build_chain(length + new_blocks - 1)
+    results = {'length': length, 'new_blocks': new_blocks}
+
+    with tempfile.TemporaryDirectory() as directory:
+        def stored(name, blocks):
+            path = os.path.join(directory, name)
+            store = BlockStore(path)
+            for block in blocks:
+                store.append(block)
+            store.sync(blocks[-1])
+            store.log.close()
+            store.index.close()
+            return path
+
+        full = stored('full', blockchain.chain)
+        behind = stored('behind', blockchain.chain[:length])
+        genesis = stored('genesis', blockchain.chain[:1])
+
+        for peer_count in peers:
+            processes = []
+            try:
+                for n in range(peer_count):
+                    path = os.path.join(directory, f'peer-{peer_count}-{n}')
+                    shutil.copytree(full, path)
+                    processes.append(start_node('flask', port + n, '--data-dir', path, '--retarget-interval', interval))
+
+                for name, ours in [('behind', behind), ('genesis', genesis)]:
+                    path = os.path.join(directory, f'ours-{peer_count}-{name}')
+                    shutil.copytree(ours, path)
+                    node = Blockchain(mining_workers=1, difficulty=1, retarget_interval=int(interval), store=BlockStore(path))
+                    for n in range(peer_count):
+                        node.register_node(f'http://127.0.0.1:{port + n}')
+
+                    seconds, replaced = timed(node.resolve_conflicts)
+                    assert replaced and node.last_block.hash == blockchain.last_block.hash
+                    results[f'{peer_count}_peers_{name}_seconds'] = seconds
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+
+    return results
+
+
+@benchmark
+def metrics_overhead(updates=200000, requests_=5000):
+    """
+    Seconds per metric update, and requests per second through /chain/head and
+    /transactions/new with and without the per-request timing hooks
+    """
+
+    counter = Counter('benchmark_total', '', ('result',))
+    histogram = Histogram('benchmark_seconds', '')
+    inc_seconds, _ = timed(lambda: [counter.inc(result='ok') for _ in range(updates)])
+    observe_seconds, _ = timed(lambda: [histogram.observe(0.003) for _ in range(updates)])
+
+    def time_block():
+        with histogram.time():
+            pass
+    timer_seconds, _ = timed(lambda: [time_block() for _ in range(updates)])
+
+    results = {
+        'updates': updates,
+        'counter_inc_seconds': inc_seconds / updates,
+        'histogram_observe_seconds': observe_seconds / updates,
+        'histogram_timer_seconds': timer_seconds / updates,
+    }
+
+    Blocky.blockchain = Blockchain(mining_workers=1)
+    client = Blocky.app.test_client()
+    hooks = Blocky.app.before_request_funcs[None], Blocky.app.after_request_funcs[None]
+
+    def run(label):
+        seconds, _ = timed(lambda: [client.get('/chain/head') for _ in range(requests_)])
+        results[f'{label}_head_requests_per_second'] = requests_ / seconds
+        seconds, _ = timed(lambda: [
+            client.post('/transactions/new', json={'sender': label, 'recipient': 'recipient', 'amount': n + 1})
+            for n in range(requests_)
+        ])
+        results[f'{label}_transaction_requests_per_second'] = requests_ / seconds
+
+    run('instrumented')
+    Blocky.app.before_request_funcs[None], Blocky.app.after_request_funcs[None] = [], []
+    try:
+        run('uninstrumented')
+    finally:
+        Blocky.app.before_request_funcs[None], Blocky.app.after_request_funcs[None] = hooks
+
+    return results
+
+
+@benchmark
+def signature_verification(transactions=5000, senders=50, batch_size=500, block_size=1000):
+    """
+    Signed transactions per second: signed, verified in one process, verified in batches
+    across a pool with a process per CPU, found in the cache of verified ids, submitted
+    through /transactions/batch in the binary encoding, and checked by valid_chain a
+    block's worth at a time
+    """
+
+    keys = [generate_key() for _ in range(senders)]
+
+    def sign_all():
+        return [Transaction(address, f'recipient-{n}', n + 1).sign(key)
+                for n, (key, address) in zip(range(transactions), keys * (transactions // senders + 1))]
+    sign_seconds, signed = timed(sign_all)
+    signatures = [transaction.signed_message() for transaction in signed]
+    pairs = [(transaction, transaction.id) for transaction in signed]
+    workers = os.cpu_count() or 1
+
+    serial_seconds, valid = timed(check_signatures, signatures)
+    pool_seconds, pool_valid = timed(verify_signatures, signatures, workers)
+    assert all(valid) and all(pool_valid)
+
+    blockchain = Blockchain(mining_workers=workers, difficulty=1, require_signatures=True)
+    first_seconds, _ = timed(blockchain.check_signatures, pairs)
+    cached_seconds, cached_valid = timed(blockchain.check_signatures, pairs)
+    assert all(cached_valid)
+
+    Blocky.blockchain = Blockchain(mining_workers=workers, difficulty=1, require_signatures=True)
+    client = Blocky.app.test_client()
+    bodies = [encode_frames([transaction.encode() for transaction in signed[start:start + batch_size]])
+              for start in range(0, transactions, batch_size)]
+    submit_seconds, _ = timed(lambda: [
+        client.post('/transactions/batch', data=body, headers={'Content-Type': BINARY_MIMETYPE}) for body in bodies
+    ])
+    assert len(Blocky.blockchain.mempool) == transactions
+
+    # Blocks as a peer would send them, their signatures not yet verified by this node
+    chain = Blocky.blockchain.chain[:]
+    for start in range(0, transactions, block_size):
+        last_block = chain[-1]
+        proof = find_proof(last_block.proof, last_block.hash, target=proof_target(1))
+        chain.append(Block(last_block.index + 1, time(), signed[start:start + block_size], proof, last_block.hash, 1))
+    chain = [Block.decode(block.encode()) for block in chain]
+    validator = Blockchain(mining_workers=workers, difficulty=1, retarget_interval=len(chain) + 1,
+                           require_signatures=True)
+    chain_seconds, chain_valid = timed(validator.valid_chain, chain)
+    assert chain_valid
+    for node in (blockchain, Blocky.blockchain, validator):
+        node.pool.close()
+
+    return {
+        'transactions': transactions,
+        'workers': workers,
+        'sign_transactions_per_second': transactions / sign_seconds,
+        'serial_transactions_per_second': transactions / serial_seconds,
+        'pool_transactions_per_second': transactions / pool_seconds,
+        'uncached_transactions_per_second': transactions / first_seconds,
+        'cached_transactions_per_second': transactions / cached_seconds,
+        'submitted_transactions_per_second': transactions / submit_seconds,
+        'valid_chain_transactions_per_second': transactions / chain_seconds,
+    }
+
+
+def summarize(runs):
+    """
+    Combine repeated runs of a benchmark, taking the median of each number
+    :param runs: <list> What each run returned
+    :return: <dict>
+    """
+
+    result = dict(runs[0])
+    for key, value in runs[0].items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            result[key] = statistics.median(run[key] for run in runs)
+
+    return result
+
+
+def regressions(result, baseline, tolerance):
+    """
+    Metrics that got worse than in a baseline run by more than tolerance.
+    Rates ending in _per_second should go up, and times and sizes ending in
+    _seconds or _bytes should go down. Anything else is not compared.
+    :param result: <dict> A benchmark's results
+    :param baseline: <dict> The same benchmark's results from the baseline run
+    :param tolerance: <float> Fraction a metric may get worse by
+    :return: <list> (metric, baseline value, new value) for each regression
+    """
+
+    worse = []
+    for key, old in baseline.items():
+        new = result.get(key)
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in (old, new)):
+            continue
+
+        if key.endswith('_per_second') and new < old * (1 - tolerance):
+            worse.append((key, old, new))
+        elif key.endswith(('_seconds', '_bytes')) and new > old * (1 + tolerance):
+            worse.append((key, old, new))
+
+    return worse
+
+
+def environment():
+    # What the numbers depend on, so runs on different machines are not compared blindly
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': Blocky.numpy is not None,
+        'time': time(),
+    }
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('-r', '--repeat', default=1, type=int, help='runs of each benchmark, reporting the median')
+    parser.add_argument('-o', '--output', default=None, help='file to also write the results to, as JSON lines')
+    parser.add_argument('-b', '--baseline', default=None, help='results of an earlier run to check for regressions against')
+    parser.add_argument('-t', '--tolerance', default=0.1, type=float, help='fraction a metric may get worse by')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as earlier:
+            records = (json.loads(line) for line in earlier if line.strip())
+            baseline = {record['benchmark']: record for record in records if 'benchmark' in record}
+
+    lines = [{'environment': environment()}]
+    print(json.dumps(lines[0]))
+
+    failed = []
+    for name in args.names or BENCHMARKS:
+        record = {'benchmark': name, **summarize([BENCHMARKS[name]() for _ in range(args.repeat)])}
+        lines.append(record)
+        print(json.dumps(record))
+
+        for key, old, new in regressions(record, baseline.get(name, {}), args.tolerance):
+            failed.append(f'{name}.{key}: {old:.6g} -> {new:.6g}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.writelines(json.dumps(line) + '\n' for line in lines)
+
+    if failed:
+        print('Regressions:', *failed, sep='\n', file=sys.stderr)
+        sys.exit(1)
@@ -9,6 +9,10 @@ from flask import Flask, jsonify, request
 from flask.wrappers import Response
 
 
+# Number of leading hex zeroes a proof hash needs, stored in every block header
+DIFFICULTY = 4
+
+
 class Blockchain(object):
 
 
@@ -48,8 +52,10 @@ class Blockchain(object):
             if block['previous_hash'] != last_block_hash:
                 return False
 
-            # Check that the Proof of Work is correct
-            if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash):
+            # Check that the block claims the difficulty every block needs, and that the Proof of Work is correct
+            if block.get('difficulty') != DIFFICULTY:
+                return False
+            if not self.valid_proof(last_block['proof'], block['proof'], block['difficulty']):
                 return False
 
             last_block = block
@@ -94,26 +100,27 @@ class Blockchain(object):
 
     def proof_of_work(self, last_block):
         ## Simple Proof of work algorithm
-        ## Find a number p such that the hash(pp') contains leading 4 zeroes, where p is the previous p'
+        ## Find a number p such that the hash(pp') contains DIFFICULTY leading hex zeroes, where p is the previous p'
         ## p is the previous proof, and p' is the new proof
 
         last_proof = last_block['proof']
         last_hash = self.hash(last_block)
 
         proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
+        while self.valid_proof(last_proof, proof) is False:
             proof += 1
         
         return proof
     
-    def valid_proof(last_proof, proof):
-        ## This validates the proof, does hash(last_proof, proof) contain 4 leading zeroes
+    @staticmethod
+    def valid_proof(last_proof, proof, difficulty=DIFFICULTY):
+        ## This validates the proof, does hash(last_proof, proof) contain difficulty leading zeroes
         ## last_proof - Previous Proof
         ## proof - current proof
 
         guess = f'{last_proof}{proof}'.encode()
         guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return guess_hash[:difficulty] == "0" * difficulty
 
     def new_block(self, proof, previous_hash):
         # Creates a new block and adds it the chain
@@ -124,7 +131,8 @@ class Blockchain(object):
             'timestamp': time(),
             'transactions': self.current_transactions,
             'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1])
+            'previous_hash': previous_hash or self.hash(self.chain[-1]),
+            'difficulty': DIFFICULTY,
         }
 
         # Reset the current list of transactions
@@ -253,10 +261,28 @@ def consensus():
 
 @app.route('/chain', methods=['GET'])
 def full_chain():
+    ## Pages of the chain can be asked for with from (a block index) and limit,
+    ## and stream=ndjson sends one block per line instead of building the whole document
+    chain = blockchain.chain
+    start = max(request.args.get('from', 1, type=int), 1) - 1
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        return 'Error: limit must be at least 1', 400
+    stop = len(chain) if limit is None else min(len(chain), start + limit)
+
+    if request.args.get('stream') == 'ndjson':
+        def generate():
+            for position in range(start, stop):
+                yield json.dumps(chain[position], sort_keys=True) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
     response = {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain),
+        'chain': chain[start:stop],
+        'length': len(chain),
     }
+    if limit is not None:
+        response['next'] = stop + 1 if stop < len(chain) else None
     return jsonify(response), 200
 
 if __name__ == '__main__':
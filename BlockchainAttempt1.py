@@ -5,6 +5,9 @@ from uuid import uuid4
 from flask import Flask, jsonify, request
 
 
+# Number of leading hex zeroes a proof hash needs, stored in every block header
+DIFFICULTY = 4
+
 ## The blockchain class manages the chain. It stores transactions and has other functions to add
 ## blocks to the chain
 
@@ -28,7 +31,8 @@ class Blockchain(object):
             'timestamp': time(),
             'transactions': self.current_transactions,
             'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1])
+            'previous_hash': previous_hash or self.hash(self.chain[-1]),
+            'difficulty': DIFFICULTY,
         }
 
         # Reset the current list of transactions
@@ -56,7 +60,7 @@ class Blockchain(object):
 
 
     # This is a simple proof of work algorithm
-    # Find a number p such that hash(pp') contains 4 leading zeroes,
+    # Find a number p such that hash(pp') contains DIFFICULTY leading hex zeroes,
     # where p is the previous p'
     ## p is the previous proof and p' is the new proof 
     def proof_of_work(self, last_proof):
@@ -69,13 +73,13 @@ class Blockchain(object):
 
 
     # This function validates the proof.
-    # It will check if the hash of p and p' have 4 leading zeroes
+    # It will check if the hash of p and p' have difficulty leading hex zeroes
     # and it will return True or False
     @staticmethod
-    def valid_proof(last_proof, proof):
+    def valid_proof(last_proof, proof, difficulty=DIFFICULTY):
         guess = f'{last_proof}{proof}'.encode()
         guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return guess_hash[:difficulty] == "0" * difficulty
         
 
     # This function will create a SHA-256 hash of the block
@@ -5,6 +5,9 @@ from time import time
 from uuid import uuid4
 from flask import Flask 
 
+# Number of leading hex zeroes a proof hash needs, stored in every block header
+DIFFICULTY = 4
+
 class Blockchain(object):
 
     def new_transaction(self, sender, recipient, amount):
@@ -23,6 +26,7 @@ class Blockchain(object):
             'transactions': self.current_transactions,
             'proof':  proof,
             'previous_hash': previous_hash or self.hash(self.chain[-1]),
+            'difficulty': DIFFICULTY,
         }
 
         self.current_transactions = []
@@ -40,17 +44,18 @@ class Blockchain(object):
 
 
     @staticmethod
-    def valid_proof(last_proof, proof):
+    def valid_proof(last_proof, proof, difficulty=DIFFICULTY):
         """
-        Validates the Proof: Does hash(last_proof, proof) contain 4 leading zeroes?
+        Validates the Proof: Does hash(last_proof, proof) contain difficulty leading hex zeroes?
         :param last_proof: <int> Previous Proof
         :param proof: <int> Current Proof
+        :param difficulty: <int> Number of leading hex zeroes
         :return: <bool> True if correct, False if not.
         """
 
         guess = f'{last_proof}{proof}'.encode()
         guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return guess_hash[:difficulty] == "0" * difficulty
 
     @staticmethod
     def hash(block):
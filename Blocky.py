@@ -1,21 +1,1994 @@
+import asyncio
+import atexit
+import bisect
 import hashlib
+import io
 import json
-from time import time
+import math
+import mmap
+import multiprocessing
+import operator
+import os
+import random
+import struct
+import sys
+import threading
+from collections import Counter as Tally, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from functools import lru_cache
+from itertools import chain, count
+from time import perf_counter, sleep, time
 from urllib.parse import urlparse
 from uuid import uuid4
 
 import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 
+try:
+    import numpy
+except ImportError:
+    # Proofs are then compared one by one, with the same results
+    numpy = None
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+except ImportError:
+    # Only needed on networks that require signed transactions
+    Ed25519PrivateKey = Ed25519PublicKey = None
+
+
+# Number of nonces handed to a mining worker at a time
+POW_CHUNK_SIZE = 50000
+
+# Difficulty is the number of leading zero bits a proof hash needs; 16 is the
+# original "0000" hex prefix
+DEFAULT_DIFFICULTY = 16
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 256
+
+# Difficulty is retargeted every RETARGET_INTERVAL blocks towards TARGET_BLOCK_TIME
+# seconds per block, by at most MAX_RETARGET_STEP bits at a time
+RETARGET_INTERVAL = 10
+TARGET_BLOCK_TIME = 10
+MAX_RETARGET_STEP = 2
+
+@lru_cache(maxsize=None)
+def proof_target(difficulty):
+    """
+    A hash is a valid proof when its raw digest sorts below this target,
+    which is the same as it starting with difficulty zero bits
+    :param difficulty: <int> Number of leading zero bits
+    :return: <bytes>
+    """
+
+    return (1 << (256 - difficulty)).to_bytes(32, 'big')
+
+
+POW_TARGET = proof_target(DEFAULT_DIFFICULTY)
+
+# Seconds to wait on a single peer, and on a whole consensus round
+PEER_TIMEOUT = 5
+CONSENSUS_DEADLINE = 15
+
+# Most peers fetched at the same time, which is also the HTTP connection pool size
+MAX_PEER_FETCHES = 16
+
+# Peers each inventory message goes to, ids remembered so they are not fetched or
+# announced twice, and seconds spent gathering announcements into one message
+GOSSIP_FANOUT = 8
+GOSSIP_SEEN_SIZE = 100000
+GOSSIP_INTERVAL = 0.05
+
+# Proofs checked per task when a chain's proofs are verified across processes
+VERIFY_CHUNK_SIZE = 20000
+
+# Signatures checked per task when they are verified across processes, and how many
+# ids of transactions whose signatures checked out are remembered
+SIGNATURE_CHUNK_SIZE = 250
+VERIFIED_CACHE_SIZE = 200000
+
+# Most blocks /chain returns in one page when a limit is asked for
+MAX_CHAIN_PAGE = 1000
+
+# Most transactions waiting to be mined, and most mined into one block
+MEMPOOL_SIZE = 50000
+MAX_BLOCK_TRANSACTIONS = 1000
+
+# Blocks kept from branches off our chain, in case one of them overtakes it
+SIDE_BLOCKS = 1000
+
+# Blocks a transaction has to be mined within: it must be newer than the block this many
+# before the one holding it, so once that block is buried it cannot be mined again
+TRANSACTION_WINDOW = 100
+
+# Coins a block's miner is rewarded with
+MINING_REWARD = 1
+
+# Seconds a block or a transaction may be dated ahead of our clock
+MAX_CLOCK_DRIFT = 60
+
+# Blocks written to the block store between fsyncs
+FSYNC_BATCH = 16
+
+# Blocks between snapshots, when a node prunes blocks deeper than its prune depth
+SNAPSHOT_INTERVAL = 100
+
+# Prefixes at least one SHA-256 block long are worth hashing once and copying
+SHA256_BLOCK_SIZE = 64
+
+# Threads the async server runs Flask views on, and how much response body to send at once
+ASGI_THREADS = 64
+ASGI_SEND_SIZE = 65536
+
+
+def find_proof(last_proof, last_hash, start=0, stop=None, found_proof=None, target=POW_TARGET, cancelled=None):
+    """
+    Scan the nonces in [start, stop) for the smallest valid proof.
+    The constant parts of the guess are encoded once, and the digest is compared
+    as raw bytes against POW_TARGET, instead of building and hex-encoding a new
+    string for every nonce.
+    :param last_proof: <int> Previous Proof
+    :param last_hash: <str> The hash of the Previous Block
+    :param start: <int> First nonce to try
+    :param stop: <int> Nonce to stop before, or None to search until found
+    :param found_proof: <multiprocessing.Value> Proof published by another worker
+    :param target: <bytes> Digests below this are valid proofs
+    :param cancelled: Callable returning True once the search should be abandoned
+    :return: <int> The smallest valid proof in the range, or None
+    """
+
+    prefix = str(last_proof).encode()
+    suffix = last_hash.encode()
+    nonces = count(start) if stop is None else range(start, stop)
+
+    def give_up():
+        # Another worker has found a proof below this range, or the search was called off
+        return ((found_proof is not None and 0 <= found_proof.value < start)
+                or (cancelled is not None and cancelled()))
+
+    checked = found_proof is not None or cancelled is not None
+
+    if len(prefix) >= SHA256_BLOCK_SIZE:
+        # Feed the whole blocks of the prefix once and resume from a copy
+        midstate = hashlib.sha256(prefix)
+        for proof in nonces:
+            if checked and proof % 1024 == 0 and give_up():
+                return None
+
+            guess = midstate.copy()
+            guess.update(b'%d%b' % (proof, suffix))
+            if guess.digest() < target:
+                return proof
+    else:
+        sha256 = hashlib.sha256
+        for proof in nonces:
+            if checked and proof % 1024 == 0 and give_up():
+                return None
+
+            if sha256(b'%b%d%b' % (prefix, proof, suffix)).digest() < target:
+                return proof
+
+    return None
+
+
+def _init_pow_worker(found_proof):
+    global _found_proof
+    _found_proof = found_proof
+
+
+def _search_proof_range(last_proof, last_hash, start, stop, target):
+    """
+    Scan the nonces in [start, stop) for a valid proof, inside a mining worker
+    :param last_proof: <int> Previous Proof
+    :param last_hash: <str> The hash of the Previous Block
+    :param start: <int> First nonce to try
+    :param stop: <int> Nonce to stop before
+    :param target: <bytes> Digests below this are valid proofs
+    :return: <int> The smallest valid proof in the range, or None
+    """
+
+    proof = find_proof(last_proof, last_hash, start, stop, _found_proof, target)
+    if proof is not None:
+        with _found_proof.get_lock():
+            if _found_proof.value < 0 or proof < _found_proof.value:
+                _found_proof.value = proof
+
+    return proof
+
+
+class WorkerPool:
+    """
+    Worker processes, started on first use and shared by mining and batch verification,
+    so a block or a batch does not pay for forking a new pool
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+        # Proof searches take turns, they share the proof the workers publish
+        self.search_lock = threading.Lock()
+        self.found_proof = None
+
+    def get(self):
+        """
+        :return: <multiprocessing.Pool> The workers, started if they are not running yet
+        """
+
+        with self.lock:
+            if self.pool is None:
+                self.found_proof = multiprocessing.Value('q', -1)
+                self.pool = multiprocessing.Pool(self.workers, initializer=_init_pow_worker,
+                                                 initargs=(self.found_proof,))
+            return self.pool
+
+    def close(self):
+        # Stops the workers, the next call to get starts new ones
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+
+def parallel_proof_of_work(last_proof, last_hash, workers, chunk_size=POW_CHUNK_SIZE, target=POW_TARGET,
+                           cancelled=None, pool=None):
+    """
+    Proof of Work spread over a pool of processes.
+    The nonce space is cut into chunks which are handed out in order, and results
+    are collected in the same order, so the first hit is the smallest valid nonce,
+    exactly what the serial search would return.
+    :param last_proof: <int> Previous Proof
+    :param last_hash: <str> The hash of the Previous Block
+    :param workers: <int> Number of worker processes
+    :param chunk_size: <int> Number of nonces per chunk
+    :param target: <bytes> Digests below this are valid proofs
+    :param cancelled: Callable returning True once the search should be abandoned
+    :param pool: <WorkerPool> Workers to search on, or None to start a pool for this search alone
+    :return: <int> The proof, or None if the search was cancelled
+    """
+
+    if pool is None:
+        pool = WorkerPool(workers)
+        try:
+            return parallel_proof_of_work(last_proof, last_hash, workers, chunk_size, target, cancelled, pool)
+        finally:
+            pool.close()
+
+    with pool.search_lock:
+        processes = pool.get()
+        found_proof = pool.found_proof
+        found_proof.value = -1
+        pending = deque()
+        try:
+            start = 0
+            while True:
+                # Keep every worker busy with a couple of chunks queued behind it
+                while len(pending) < workers * 2:
+                    pending.append(processes.apply_async(
+                        _search_proof_range, (last_proof, last_hash, start, start + chunk_size, target)
+                    ))
+                    start += chunk_size
+
+                # Checked between chunks, which take a fraction of a second each
+                if cancelled is not None and cancelled():
+                    return None
+
+                proof = pending.popleft().get()
+                if proof is not None:
+                    return proof
+        finally:
+            # The chunks still queued or scanning give up at their next check. They are
+            # waited for, so none of them publish a proof into the next search.
+            with found_proof.get_lock():
+                found_proof.value = 0
+            for result in pending:
+                result.wait()
+
+
+def check_proofs(proofs):
+    """
+    Check a batch of proofs of work in one go, with no Python call per proof
+    beyond hashing it. Gives the same answers as Blockchain.valid_proof.
+    :param proofs: <list> (last_proof, proof, last_hash, difficulty) for each proof
+    :return: <list> True for each proof that is valid, False for each that is not
+    """
+
+    sha256 = hashlib.sha256
+    digests = [sha256(f'{last_proof}{proof}{last_hash}'.encode()).digest()
+               for last_proof, proof, last_hash, _ in proofs]
+
+    if numpy is None or not proofs:
+        return list(map(operator.lt, digests, [proof_target(difficulty) for _, _, _, difficulty in proofs]))
+
+    # A digest is below the target for difficulty d exactly when its first d bits are all zero
+    words = numpy.frombuffer(b''.join(digests), dtype='>u8').reshape(-1, 4)
+    masks = difficulty_masks()[[difficulty for _, _, _, difficulty in proofs]]
+    return ((words & masks) == 0).all(axis=1).tolist()
+
+
+@lru_cache(maxsize=None)
+def difficulty_masks():
+    """
+    :return: <numpy.ndarray> For each difficulty, the bits a digest needs clear, as four 64-bit words
+    """
+
+    masks = numpy.zeros((MAX_DIFFICULTY + 1, 4), dtype=numpy.uint64)
+    for difficulty in range(MAX_DIFFICULTY + 1):
+        for word in range(4):
+            bits = min(max(difficulty - 64 * word, 0), 64)
+            masks[difficulty, word] = ((1 << bits) - 1) << (64 - bits)
+
+    return masks
+
+
+def map_chunks(function, items, workers, chunk_size, pool=None):
+    """
+    Run a batch check over items cut into chunks, one chunk per task, across worker processes
+    :param function: Callable taking a list of items and returning a list of results
+    :param items: <list>
+    :param workers: <int> Number of worker processes
+    :param chunk_size: <int> Items per task
+    :param pool: <WorkerPool> Workers to run on, or None to start a pool for this batch alone
+    :return: <list> The results, in the order of the items
+    """
+
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    if pool is not None:
+        results = pool.get().map(function, chunks)
+    else:
+        with multiprocessing.Pool(min(workers, len(chunks))) as processes:
+            results = processes.map(function, chunks)
+
+    return [result for chunk in results for result in chunk]
+
+
+def verify_proofs(proofs, workers=1, chunk_size=VERIFY_CHUNK_SIZE, pool=None):
+    """
+    check_proofs, spread over a pool of processes when there are enough proofs to make it worthwhile
+    :param proofs: <list> (last_proof, proof, last_hash, difficulty) for each proof
+    :param workers: <int> Number of worker processes
+    :param chunk_size: <int> Proofs per task
+    :param pool: <WorkerPool> Workers to run on, or None to start a pool for this batch alone
+    :return: <list> True for each proof that is valid, False for each that is not
+    """
+
+    if workers < 2 or len(proofs) <= chunk_size:
+        return check_proofs(proofs)
+
+    return map_chunks(check_proofs, proofs, workers, chunk_size, pool)
+
+
+def check_signatures(signatures):
+    """
+    :param signatures: <list> (public key, signature, signed message) for each signature, all bytes
+    :return: <list> True for each signature that is valid, False for each that is not
+    """
+
+    results = []
+    for public_key, signature, message in signatures:
+        try:
+            Ed25519PublicKey.from_public_bytes(public_key).verify(signature, message)
+            results.append(True)
+        except (InvalidSignature, ValueError):
+            results.append(False)
+
+    return results
+
+
+def verify_signatures(signatures, workers=1, chunk_size=SIGNATURE_CHUNK_SIZE, pool=None):
+    """
+    check_signatures, spread over a pool of processes when there are enough signatures to make it worthwhile
+    :param signatures: <list> (public key, signature, signed message) for each signature
+    :param workers: <int> Number of worker processes
+    :param chunk_size: <int> Signatures per task
+    :param pool: <WorkerPool> Workers to run on, or None to start a pool for this batch alone
+    :return: <list> True for each signature that is valid, False for each that is not
+    """
+
+    if workers < 2 or len(signatures) <= chunk_size:
+        return check_signatures(signatures)
+
+    return map_chunks(check_signatures, signatures, workers, chunk_size, pool)
+
+
+def generate_key():
+    """
+    A new key to sign transactions with
+    :return: <tuple> (Ed25519PrivateKey, the address it signs for: its public key in hex)
+    """
+
+    private_key = Ed25519PrivateKey.generate()
+    return private_key, private_key.public_key().public_bytes_raw().hex()
+
+
+def hash_block(block):
+    """
+    Creates a SHA-256 hash of a Block from its header's binary encoding
+    :param block: <Block>
+    :return: <str>
+    """
+
+    return hashlib.sha256(block.encode_header()).hexdigest()
+
+
+# Media type of the binary encoding, and the length prefix framing each record in it
+BINARY_MIMETYPE = 'application/x-blocky'
+FRAME = struct.Struct('<I')
+
+
+def encode_frames(records):
+    """
+    :param records: Encoded blocks or transactions
+    :return: <bytes> Each record prefixed with its length
+    """
+
+    return b''.join(FRAME.pack(len(record)) + record for record in records)
+
+
+def decode_frames(data):
+    """
+    Split length-prefixed records apart
+    :param data: <bytes>
+    :return: Generator of the records, as memoryviews
+    :raises ValueError: If the last record is cut short
+    """
+
+    data = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        if offset + FRAME.size > len(data):
+            raise ValueError('Truncated record')
+        (length,), offset = FRAME.unpack_from(data, offset), offset + FRAME.size
+        if offset + length > len(data):
+            raise ValueError('Truncated record')
+        yield data[offset:offset + length]
+        offset += length
+
+
+class Transaction:
+    """
+    A transfer of coins between two addresses.
+    Its id is the hash of its binary encoding, and the timestamp keeps otherwise
+    identical payments, like repeated mining rewards, apart.
+    The binary encoding is the lengths of the two addresses, the addresses in UTF-8,
+    the timestamp, the amount tagged as an integer or a float, and the signature
+    if there is one. A signed transaction's sender is an Ed25519 public key in hex,
+    and it signs the encoding the transaction would have unsigned.
+    """
+
+    __slots__ = ('sender', 'recipient', 'amount', 'timestamp', 'signature')
+
+    LENGTHS = struct.Struct('<HH')
+    INTEGER_AMOUNT = struct.Struct('<dBq')
+    FLOAT_AMOUNT = struct.Struct('<dBd')
+
+    # Bits of the amount's tag, and the sizes of a public key and a signature
+    FLOAT_TAG = 1
+    SIGNED_TAG = 2
+    KEY_SIZE = 32
+    SIGNATURE_SIZE = 64
+
+    def __init__(self, sender, recipient, amount, timestamp=None, signature=None):
+        self.sender = sender
+        self.recipient = recipient
+        self.amount = amount
+        self.timestamp = time() if timestamp is None else timestamp
+        self.signature = signature
+
+    def valid_amount(self):
+        """
+        :return: <bool> True if the amount is a finite number above zero
+        """
+
+        return type(self.amount) in (int, float) and 0 < self.amount < math.inf
+
+    @property
+    def id(self):
+        # Worked out when asked for rather than kept, the ledger holds on to the ones it needs
+        return hashlib.sha256(self.encode()).hexdigest()
+
+    def encode(self, signed=True):
+        """
+        :param signed: <bool> False for the encoding without the signature, which is what the signature covers
+        :return: <bytes> The transaction's binary encoding
+        :raises ValueError: If a field does not fit the encoding
+        """
+
+        signature = self.signature if signed else None
+        if signature is not None and len(signature) != self.SIGNATURE_SIZE:
+            raise ValueError(f'A signature is {self.SIGNATURE_SIZE} bytes')
+
+        try:
+            sender = self.sender.encode()
+            recipient = self.recipient.encode()
+            tag = 0 if signature is None else self.SIGNED_TAG
+            if isinstance(self.amount, int):
+                amount = self.INTEGER_AMOUNT.pack(self.timestamp, tag, self.amount)
+            else:
+                amount = self.FLOAT_AMOUNT.pack(self.timestamp, tag | self.FLOAT_TAG, self.amount)
+            return self.LENGTHS.pack(len(sender), len(recipient)) + sender + recipient + amount + (signature or b'')
+        except (struct.error, AttributeError, TypeError) as error:
+            raise ValueError(f'Transaction does not fit the binary encoding: {error}')
+
+    def sign(self, private_key):
+        """
+        :param private_key: <Ed25519PrivateKey> The key of the sender's address
+        :return: <Transaction> This transaction, signed
+        """
+
+        self.signature = private_key.sign(self.encode(signed=False))
+        return self
+
+    def signed_message(self):
+        """
+        :return: <tuple> (sender's public key, signature, the bytes it signs), or None if
+                 the transaction is unsigned or its sender is not a public key
+        """
+
+        if self.signature is None:
+            return None
+        try:
+            public_key = bytes.fromhex(self.sender)
+        except ValueError:
+            return None
+        if len(public_key) != self.KEY_SIZE:
+            return None
+
+        return public_key, self.signature, self.encode(signed=False)
+
+    @classmethod
+    def decode(cls, data, offset=0):
+        """
+        :param data: <bytes> Holding a binary encoded transaction
+        :param offset: <int> Where in data it starts
+        :return: <tuple> (Transaction, offset just past it)
+        :raises ValueError: If data does not hold a transaction there
+        """
+
+        try:
+            sender_length, recipient_length = cls.LENGTHS.unpack_from(data, offset)
+            offset += cls.LENGTHS.size
+            sender = str(data[offset:offset + sender_length], 'utf-8')
+            offset += sender_length
+            recipient = str(data[offset:offset + recipient_length], 'utf-8')
+            offset += recipient_length
+            tag = data[offset + 8]
+            timestamp, _, amount = (cls.FLOAT_AMOUNT if tag & cls.FLOAT_TAG else cls.INTEGER_AMOUNT).unpack_from(data, offset)
+        except (struct.error, IndexError) as error:
+            raise ValueError(f'Truncated transaction: {error}')
+        # Only one encoding per transaction, so its bytes can be hashed for its id as they are
+        if tag > cls.FLOAT_TAG | cls.SIGNED_TAG:
+            raise ValueError('Unknown amount type')
+
+        offset += cls.INTEGER_AMOUNT.size
+        signature = None
+        if tag & cls.SIGNED_TAG:
+            signature = bytes(data[offset:offset + cls.SIGNATURE_SIZE])
+            if len(signature) != cls.SIGNATURE_SIZE:
+                raise ValueError('Truncated signature')
+            offset += cls.SIGNATURE_SIZE
+
+        return cls(sender, recipient, amount, timestamp, signature), offset
+
+    def to_dict(self):
+        transaction = {
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'amount': self.amount,
+            'timestamp': self.timestamp,
+        }
+        if self.signature is not None:
+            transaction['signature'] = self.signature.hex()
+        return transaction
+
+    @classmethod
+    def from_dict(cls, transaction):
+        """
+        :param transaction: <dict> Transaction in the JSON wire format
+        :return: <Transaction>
+        """
+
+        if isinstance(transaction, cls):
+            return transaction
+
+        signature = transaction.get('signature')
+        return cls(transaction['sender'], transaction['recipient'], transaction['amount'], transaction['timestamp'],
+                   None if signature is None else bytes.fromhex(signature))
+
+
+def merkle_levels(txids):
+    """
+    Every level of the Merkle tree over a block's transactions, from the leaves up.
+    Interior nodes hash a 0x01 byte and their two children's raw digests, and a node
+    left without a sibling moves up a level unchanged.
+    :param txids: <list> Transaction ids, which are the leaves
+    :return: <list> Levels of hex digests, the last holding only the root
+    """
+
+    level = list(txids) or [hashlib.sha256(b'').hexdigest()]
+    levels = [level]
+    while len(level) > 1:
+        parents = [
+            hashlib.sha256(b'\x01' + bytes.fromhex(level[i]) + bytes.fromhex(level[i + 1])).hexdigest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+        levels.append(level)
+
+    return levels
+
+
+def merkle_root_of(txids):
+    """
+    :param txids: <list> Transaction ids
+    :return: <str> Root of the Merkle tree over them
+    """
+
+    return merkle_levels(txids)[-1][0]
+
+
+def merkle_proof(txids, position):
+    """
+    Inclusion proof for one transaction: the sibling at each level on the way to the root
+    :param txids: <list> Transaction ids of the block
+    :param position: <int> Position of the transaction in the block
+    :return: <list> [side, hash] pairs, side being the sibling's side, 'left' or 'right'
+    """
+
+    proof = []
+    for level in merkle_levels(txids)[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append(['left' if sibling < position else 'right', level[sibling]])
+        position //= 2
+
+    return proof
+
+
+def verify_merkle_proof(txid, proof, root):
+    """
+    Check an inclusion proof, without needing the rest of the block
+    :param txid: <str> Transaction id
+    :param proof: <list> Proof from merkle_proof
+    :param root: <str> Merkle root from the block header
+    :return: <bool>
+    """
+
+    node = bytes.fromhex(txid)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        pair = sibling + node if side == 'left' else node + sibling
+        node = hashlib.sha256(b'\x01' + pair).digest()
+
+    return node.hex() == root
+
+
+class Block:
+    """
+    A block that has been sealed into a chain.
+    Its fields must not change from then on, so its hash is worked out once
+    and kept alongside it instead of re-serializing the block on every lookup.
+    The hash covers only the header, which commits to the transactions
+    through their Merkle root.
+    to_dict gives back the block's JSON wire format, and encode its binary one: the
+    header, then the number of transactions and each transaction's binary encoding.
+    """
+
+    __slots__ = ('index', 'timestamp', 'transactions', 'merkle_root', 'proof', 'previous_hash', 'difficulty', 'hash')
+
+    # index, timestamp, Merkle root, proof, difficulty and the length of the previous hash, which follows
+    HEADER = struct.Struct('<Qd32sQHB')
+    COUNT = struct.Struct('<I')
+
+    def __init__(self, index, timestamp, transactions, proof, previous_hash, difficulty,
+                 merkle_root=None, block_hash=None):
+        self.index = index
+        self.timestamp = timestamp
+        self.transactions = transactions
+        self.merkle_root = merkle_root or merkle_root_of(self.txids())
+        self.proof = proof
+        self.previous_hash = previous_hash
+        self.difficulty = difficulty
+        self.hash = block_hash or hash_block(self)
+
+    def txids(self):
+        return [transaction.id for transaction in self.transactions]
+
+    def header(self):
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'merkle_root': self.merkle_root,
+            'proof': self.proof,
+            'previous_hash': self.previous_hash,
+            'difficulty': self.difficulty,
+        }
+
+    def to_dict(self):
+        return {
+            **self.header(),
+            'transactions': [transaction.to_dict() for transaction in self.transactions],
+        }
+
+    def encode_header(self):
+        """
+        :return: <bytes> The header's binary encoding, which is what the block's hash covers
+        :raises ValueError: If a field does not fit the encoding
+        """
+
+        try:
+            previous_hash = self.previous_hash.encode()
+            return self.HEADER.pack(self.index, self.timestamp, bytes.fromhex(self.merkle_root), self.proof,
+                                    self.difficulty, len(previous_hash)) + previous_hash
+        except (struct.error, AttributeError) as error:
+            raise ValueError(f'Block does not fit the binary encoding: {error}')
+
+    def encode(self):
+        """
+        :return: <bytes> The block's binary encoding
+        """
+
+        return b''.join([
+            self.encode_header(),
+            self.COUNT.pack(len(self.transactions)),
+            *(transaction.encode() for transaction in self.transactions),
+        ])
+
+    @classmethod
+    def decode(cls, data, block_hash=None):
+        """
+        :param data: <bytes> A binary encoded block
+        :param block_hash: <str> Hash of the block, if it is already trusted
+        :return: <Block>
+        :raises ValueError: If data is not a block, or the Merkle root does not match the transactions
+        """
+
+        try:
+            index, timestamp, merkle_root, proof, difficulty, length = cls.HEADER.unpack_from(data)
+            offset = cls.HEADER.size
+            previous_hash = str(data[offset:offset + length], 'utf-8')
+            offset += length
+            count, = cls.COUNT.unpack_from(data, offset)
+            offset += cls.COUNT.size
+        except struct.error as error:
+            raise ValueError(f'Truncated block: {error}')
+
+        transactions = []
+        txids = []
+        for _ in range(count):
+            start = offset
+            transaction, offset = Transaction.decode(data, offset)
+            transactions.append(transaction)
+            if not block_hash:
+                # The bytes we were sent are the ones its id is the hash of
+                txids.append(hashlib.sha256(data[start:offset]).hexdigest())
+        if offset != len(data):
+            raise ValueError('Trailing bytes after block')
+
+        # A trusted block's root is taken as it is, anything else is worked out again
+        merkle_root = merkle_root.hex()
+        if not block_hash and merkle_root_of(txids) != merkle_root:
+            raise ValueError('Merkle root does not match the transactions')
+
+        return cls(index, timestamp, transactions, proof, previous_hash, difficulty, merkle_root, block_hash)
+
+    @classmethod
+    def from_dict(cls, block, block_hash=None):
+        """
+        :param block: <dict> Block in the JSON wire format
+        :param block_hash: <str> Hash of the block, if it is already trusted
+        :return: <Block>
+        :raises ValueError: If the Merkle root does not match the transactions
+        """
+
+        if isinstance(block, cls):
+            return block
+
+        sealed = cls(
+            block['index'],
+            block['timestamp'],
+            [Transaction.from_dict(transaction) for transaction in block['transactions']],
+            block['proof'],
+            block['previous_hash'],
+            block['difficulty'],
+            # A trusted block's root is taken as it is, anything else is worked out again
+            block['merkle_root'] if block_hash else None,
+            block_hash,
+        )
+        if sealed.merkle_root != block['merkle_root']:
+            raise ValueError('Merkle root does not match the transactions')
+
+        return sealed
+
+
+class BlockJSONProvider(DefaultJSONProvider):
+    """
+    Lets jsonify send Blocks and Transactions in their wire format
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, (Block, Transaction)):
+            return o.to_dict()
+
+        return DefaultJSONProvider.default(o)
+
+
+class Ledger:
+    """
+    Indexes over the transactions in a chain, kept up to date block by block:
+     - where each transaction is, by id
+     - the balance of every address, and the ids of the transactions it took part in
+    Once the oldest blocks are pruned, their transactions are dropped from the indexes
+    and only counted towards the balances and numbers of transactions settled before them.
+    """
+
+    def __init__(self):
+        self.transactions = {}
+        self.balances = {}
+        self.history = {}
+        self.settled_balances = {}
+        self.settled_counts = {}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        :param snapshot: <dict> Snapshot taken by Blockchain.take_snapshot
+        :return: <Ledger> The indexes as of the snapshot's last block
+        """
+
+        ledger = cls()
+        ledger.settled_balances = dict(snapshot['balances'])
+        ledger.settled_counts = dict(snapshot['transactions'])
+        ledger.balances = dict(ledger.settled_balances)
+        return ledger
+
+    def add_block(self, block, position):
+        """
+        :param block: <Block> Block joining the end of the chain
+        :param position: <int> Its position in the chain
+        """
+
+        for offset, transaction in enumerate(block.transactions):
+            txid = transaction.id
+            self.transactions[txid] = (position, offset)
+
+            # The sender "0" mints new coins rather than spending them
+            if transaction.sender != "0":
+                self.balances[transaction.sender] = self.balances.get(transaction.sender, 0) - transaction.amount
+                self.history.setdefault(transaction.sender, []).append(txid)
+
+            self.balances[transaction.recipient] = self.balances.get(transaction.recipient, 0) + transaction.amount
+            if transaction.recipient != transaction.sender:
+                self.history.setdefault(transaction.recipient, []).append(txid)
+
+    def remove_block(self, block):
+        """
+        Undo add_block, for the block at the end of the chain
+        :param block: <Block>
+        """
+
+        for transaction in reversed(block.transactions):
+            self.transactions.pop(transaction.id, None)
+
+            self.balances[transaction.recipient] -= transaction.amount
+            if transaction.recipient != transaction.sender:
+                self.forget_last(transaction.recipient)
+
+            if transaction.sender != "0":
+                self.balances[transaction.sender] += transaction.amount
+                self.forget_last(transaction.sender)
+
+    def forget_last(self, address):
+        # Drop an address's latest transaction, and the address once it has none left
+        history = self.history[address]
+        history.pop()
+        if not history:
+            del self.history[address]
+            if address not in self.settled_counts:
+                del self.balances[address]
+
+    def prune_block(self, block):
+        """
+        Settle the oldest block still in the indexes
+        :param block: <Block>
+        """
+
+        for transaction in block.transactions:
+            self.transactions.pop(transaction.id, None)
+
+            if transaction.sender != "0":
+                self.settle(transaction.sender, -transaction.amount, True)
+            self.settle(transaction.recipient, transaction.amount, transaction.recipient != transaction.sender)
+
+    def settle(self, address, amount, counted):
+        # Move an address's oldest transaction out of its history and into its settled totals
+        self.settled_balances[address] = self.settled_balances.get(address, 0) + amount
+        if counted:
+            self.settled_counts[address] = self.settled_counts.get(address, 0) + 1
+            history = self.history[address]
+            history.pop(0)
+            if not history:
+                del self.history[address]
+
+    def count(self, address):
+        """
+        :param address: <str>
+        :return: <int> Number of transactions the address took part in
+        """
+
+        return len(self.history.get(address, ())) + self.settled_counts.get(address, 0)
+
+    def save(self, path, chain):
+        """
+        Write the indexes to disk, so a restart does not have to rebuild them
+        :param path: File to write to
+        :param chain: The chain the indexes describe
+        """
+
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as ledger:
+            json.dump({
+                'length': len(chain),
+                'hash': chain[-1].hash,
+                'transactions': self.transactions,
+                'balances': self.balances,
+                'history': self.history,
+            }, ledger)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path, chain):
+        """
+        Read the indexes back from disk and bring them up to date with a chain
+        :param path: File written by save
+        :param chain: The chain the indexes should describe
+        :return: <Ledger>
+        """
+
+        ledger = cls()
+        length = 0
+        try:
+            with open(path) as saved:
+                values = json.load(saved)
+            if 0 < values['length'] <= len(chain) and chain[values['length'] - 1].hash == values['hash']:
+                ledger.transactions = {txid: tuple(location) for txid, location in values['transactions'].items()}
+                ledger.balances = values['balances']
+                ledger.history = values['history']
+                length = values['length']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        for position in range(length, len(chain)):
+            ledger.add_block(chain[position], position)
+
+        return ledger
+
+
+class Mempool:
+    """
+    Transactions waiting to be mined, in the order they arrived.
+    A transaction that is already waiting is not added twice, and once the pool
+    holds max_size transactions the oldest ones are evicted to make room.
+    Callers hold lock to make several calls in a row atomic.
+    """
+
+    def __init__(self, max_size=MEMPOOL_SIZE):
+        self.transactions = OrderedDict()
+        self.max_size = max_size
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, txid):
+        return txid in self.transactions
+
+    def add(self, transaction, txid=None):
+        """
+        :param transaction: <Transaction>
+        :param txid: <str> Its id, if already worked out
+        :return: <bool> True if it was added, False if it was already waiting
+        """
+
+        txid = txid or transaction.id
+        with self.lock:
+            if txid in self.transactions:
+                return False
+
+            self.transactions[txid] = transaction
+            while len(self.transactions) > self.max_size:
+                self.transactions.popitem(last=False)
+
+        return True
+
+    def block_template(self, max_transactions, after=-math.inf, until=math.inf):
+        """
+        :param max_transactions: <int> Most transactions to pick
+        :param after: <float> Transactions must be newer than this, older ones are dropped
+        :param until: <float> Transactions must be no newer than this, newer ones wait
+        :return: <list> The transactions that have waited longest
+        """
+
+        with self.lock:
+            picked = []
+            stale = []
+            for txid, transaction in self.transactions.items():
+                if len(picked) == max_transactions:
+                    break
+                if transaction.timestamp <= after:
+                    stale.append(txid)
+                elif transaction.timestamp <= until:
+                    picked.append(transaction)
+
+            # Too old for this block, and so for any block after it
+            for txid in stale:
+                del self.transactions[txid]
+
+            return picked
+
+    def remove(self, txids):
+        """
+        Drop transactions that have made it into a block
+        :param txids: Ids of the transactions
+        """
+
+        with self.lock:
+            for txid in txids:
+                self.transactions.pop(txid, None)
+
+    def restore(self, transactions):
+        """
+        Put back transactions from blocks a reorg dropped. They have waited longest,
+        so they go ahead of the others, and make room by evicting the newest.
+        :param transactions: <list> (Transaction, id) pairs, oldest first
+        """
+
+        with self.lock:
+            for transaction, txid in reversed(transactions):
+                if txid not in self.transactions:
+                    self.transactions[txid] = transaction
+                    self.transactions.move_to_end(txid, last=False)
+            while len(self.transactions) > self.max_size:
+                self.transactions.popitem()
+
+
+class BlockTree:
+    """
+    Verified blocks on branches off our chain: the ones a reorg dropped, and peers'
+    blocks that did not have more work than our chain when they arrived.
+    When a peer's branch grows past our chain's work, only its blocks after the ones
+    kept here are downloaded and verified. At most max_size blocks are kept, and the
+    ones learned of first are forgotten first.
+    """
+
+    def __init__(self, max_size=SIDE_BLOCKS):
+        self.blocks = OrderedDict()
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks
+
+    def add(self, blocks):
+        """
+        :param blocks: Verified blocks, each one's parent before it on our chain or in the tree
+        """
+
+        with self.lock:
+            for block in blocks:
+                self.blocks[block.hash] = block
+                self.blocks.move_to_end(block.hash)
+            while len(self.blocks) > self.max_size:
+                self.blocks.popitem(last=False)
+
+    def discard(self, blocks):
+        """
+        :param blocks: Blocks that joined our chain
+        """
+
+        with self.lock:
+            for block in blocks:
+                self.blocks.pop(block.hash, None)
+
+    def forget_before(self, length):
+        """
+        Forget the blocks that would fork from before a chain's first length blocks
+        :param length: <int>
+        """
+
+        with self.lock:
+            for block_hash in [block.hash for block in self.blocks.values() if block.index <= length]:
+                del self.blocks[block_hash]
+
+    def branch(self, block_hash, chain, length):
+        """
+        Follow a branch back from one of its blocks to where it leaves a chain
+        :param block_hash: <str> Hash of the branch's last block
+        :param chain: <list> The chain it branches off
+        :param length: <int> Number of blocks in that chain
+        :return: <tuple> (number of blocks it shares with the chain, the branch's blocks after them),
+                 or None if it does not lead back to the chain
+        """
+
+        blocks = []
+        with self.lock:
+            block = self.blocks.get(block_hash)
+            while block is not None:
+                blocks.append(block)
+                position = block.index - 1
+                if position == 0:
+                    break
+                parent = chain[position - 1] if position <= length else None
+                if parent is not None and parent.hash == block.previous_hash:
+                    break
+                block = self.blocks.get(block.previous_hash)
+            else:
+                return None
+
+        blocks.reverse()
+        return blocks[0].index - 1, blocks
+
+
+class Miner:
+    """
+    Mines blocks on a background thread, one after another, until stopped.
+    The block being worked on is abandoned as soon as the chain's tip changes
+    under it, for instance when consensus replaces our chain.
+    """
+
+    def __init__(self, blockchain, reward_address):
+        self.blockchain = blockchain
+        self.reward_address = reward_address
+        self.stopping = threading.Event()
+        self.thread = None
+
+        self.blocks_mined = 0
+        self.jobs_abandoned = 0
+        self.job = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """
+        :return: <bool> True if mining started, False if it was already running
+        """
+
+        if self.running:
+            return False
+
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='miner', daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """
+        :return: <bool> True if mining was running
+        """
+
+        if not self.running:
+            return False
+
+        self.stopping.set()
+        self.thread.join()
+        return True
+
+    def run(self):
+        while not self.stopping.is_set():
+            tip = self.blockchain.last_block
+            self.job = {
+                'index': tip.index + 1,
+                'difficulty': self.blockchain.next_difficulty(self.blockchain.chain),
+                'started': time(),
+            }
+
+            block = self.blockchain.mine(
+                self.reward_address,
+                cancelled=lambda: self.stopping.is_set() or self.blockchain.last_block is not tip,
+            )
+            if block is None:
+                self.jobs_abandoned += 1
+            else:
+                self.blocks_mined += 1
+
+        self.job = None
+
+    def status(self):
+        return {
+            'running': self.running,
+            'blocks_mined': self.blocks_mined,
+            'jobs_abandoned': self.jobs_abandoned,
+            'job': self.job,
+        }
+
+
+class Gossip:
+    """
+    Pushes new blocks and transactions to our peers, rather than waiting for them to poll.
+     - New ids are announced in an inventory message to at most fanout random peers
+     - A peer answers with the transactions it lacks, which are then pushed to it,
+       and fetches blocks it lacks from the end of our chain
+     - Nothing is asked for or announced twice, so a message dies out once every node has it
+    """
+
+    def __init__(self, blockchain, port, fanout=GOSSIP_FANOUT, seen_size=GOSSIP_SEEN_SIZE):
+        self.blockchain = blockchain
+        # Peers fetch the blocks we announce from this port at our address
+        self.port = port
+        self.fanout = fanout
+        self.seen_size = seen_size
+
+        # Ids we have announced, and ids we have asked peers for
+        self.announced = OrderedDict()
+        self.requested = OrderedDict()
+
+        # Announcements waiting for the next inventory message
+        self.lock = threading.Condition()
+        self.tip = None
+        self.transactions = []
+        self.thread = None
+        self.executor = ThreadPoolExecutor(max_workers=MAX_PEER_FETCHES, thread_name_prefix='gossip')
+
+        # A session of our own, so gossip traffic is counted apart from consensus
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_PEER_FETCHES))
+        self.session.hooks['response'].append(self.count_bytes)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.inventories_sent = 0
+        self.inventories_received = 0
+
+        blockchain.watchers.append(self.announce_block)
+
+    def first_sight(self, seen, ids):
+        """
+        Remember ids in one of the seen sets
+        :param seen: <OrderedDict> self.announced or self.requested
+        :param ids: Block hashes or transaction ids
+        :return: <list> The ids that were not already in it
+        """
+
+        new = []
+        with self.lock:
+            for item in ids:
+                if item not in seen:
+                    seen[item] = None
+                    new.append(item)
+            while len(seen) > self.seen_size:
+                seen.popitem(last=False)
+
+        return new
+
+    def announce_block(self, block):
+        """
+        Queue our chain's new tip for announcing
+        :param block: <Block>
+        """
+
+        # Called as the tip is published, so total_work is the work up to it
+        if self.first_sight(self.announced, [block.hash]):
+            with self.lock:
+                self.tip = (block, self.blockchain.total_work)
+                self.wake()
+
+    def announce_transactions(self, txids):
+        """
+        Queue transactions that joined our mempool for announcing
+        :param txids: <list> Their ids
+        """
+
+        txids = self.first_sight(self.announced, txids)
+        if txids:
+            with self.lock:
+                self.transactions.extend(txids)
+                self.wake()
+
+    def wake(self):
+        # Called holding self.lock
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='gossip', daemon=True)
+            self.thread.start()
+        self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while self.tip is None and not self.transactions:
+                    self.lock.wait()
+                tip, self.tip = self.tip, None
+                transactions, self.transactions = self.transactions, []
+
+            inventory = {'port': self.port, 'transactions': transactions}
+            if tip is not None:
+                block, work = tip
+                inventory['blocks'] = [block.hash]
+                inventory['length'] = block.index
+                inventory['work'] = work
+
+            nodes = list(self.blockchain.nodes)
+            for node in random.sample(nodes, min(self.fanout, len(nodes))):
+                self.executor.submit(self.send, node, inventory)
+
+            # Whatever is announced meanwhile goes out together in the next message
+            sleep(GOSSIP_INTERVAL)
+
+    def send(self, node, inventory):
+        """
+        Send an inventory message, and push the transactions the peer asks for
+        :param node: Address of the node. Eg. '192.168.0.5:5000'
+        :param inventory: <dict>
+        """
+
+        try:
+            response = self.session.post(f'http://{node}/inv', json=inventory, timeout=PEER_TIMEOUT)
+            with self.lock:
+                self.inventories_sent += 1
+            if response.status_code != 200:
+                return
+
+            # Anything mined since has left the mempool, and reaches the peer in its block
+            mempool = self.blockchain.mempool.transactions
+            wanted = (mempool.get(txid) for txid in response.json()['transactions'])
+            transactions = [transaction.encode() for transaction in wanted if transaction is not None]
+            if transactions:
+                self.session.post(f'http://{node}/transactions/batch', data=encode_frames(transactions),
+                                  headers={'Content-Type': BINARY_MIMETYPE}, timeout=PEER_TIMEOUT)
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            pass
+
+    def receive(self, inventory, address):
+        """
+        Handle a peer's inventory message
+        :param inventory: <dict> Its message
+        :param address: <str> The peer's host, as it connected to us
+        :return: <list> Ids of the transactions it should push to us
+        """
+
+        with self.lock:
+            self.inventories_received += 1
+
+        # Branches with as much work as ours are fetched too, and kept in case they overtake it.
+        # Peers that do not send the work are compared by length.
+        blocks = self.first_sight(self.requested, inventory.get('blocks', []))
+        if blocks:
+            _, length, work = self.blockchain.head
+            if 'work' in inventory:
+                heavier = inventory['work'] >= work
+            else:
+                heavier = inventory['length'] > length
+            if heavier:
+                self.executor.submit(self.catch_up, f"{address}:{int(inventory['port'])}")
+
+        ledger = self.blockchain.ledger.transactions
+        mempool = self.blockchain.mempool
+        wanted = [txid for txid in inventory['transactions'] if txid not in mempool and txid not in ledger]
+        return self.first_sight(self.requested, wanted)
+
+    def catch_up(self, node):
+        # Fetch only the blocks past our tip, which announces the new tip on to our own peers
+        result = self.blockchain.fetch_chain(node, self.blockchain.head[2], self.session)
+        if result is not None:
+            self.blockchain.replace_chain(*result)
+
+    def count_bytes(self, response, *args, **kwargs):
+        body = response.request.body or b''
+        with self.lock:
+            self.bytes_sent += len(body)
+            self.bytes_received += len(response.content)
+
+    def status(self):
+        return {
+            'peers': len(self.blockchain.nodes),
+            'fanout': self.fanout,
+            'inventories_sent': self.inventories_sent,
+            'inventories_received': self.inventories_received,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+
+class BlockStore:
+    """
+    Append-only log of blocks on disk, so a node can restart without downloading its chain again.
+     - blocks.log holds each block's binary encoding, prefixed with its length
+     - blocks.idx holds a fixed-size record per block: its offset in the log and its hash
+     - checkpoint records how many blocks had been verified and fsynced
+     - snapshot holds the latest snapshot, when the node prunes
+     - base holds the position of the first block in the log, when the node was bootstrapped
+       from a snapshot rather than from genesis
+    """
+
+    INDEX_RECORD = struct.Struct('<Q32s')
+
+    def __init__(self, path, sync_every=FSYNC_BATCH):
+        """
+        :param path: Directory to keep the files in, created if needed
+        :param sync_every: <int> Blocks appended between fsyncs
+        """
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.checkpoint_path = os.path.join(path, 'checkpoint')
+        self.snapshot_path = os.path.join(path, 'snapshot')
+        self.base_path = os.path.join(path, 'base')
+        self.log = open(os.path.join(path, 'blocks.log'), 'a+b')
+        self.index = open(os.path.join(path, 'blocks.idx'), 'a+b')
+        self.sync_every = sync_every
+        self.unsynced = 0
+
+        try:
+            with open(self.base_path) as base:
+                self.base = json.load(base)
+        except (OSError, ValueError):
+            self.base = 0
+
+        self.recover()
+
+    def __len__(self):
+        return self.length
+
+    def recover(self):
+        """
+        Drop a record that was only half written when the node last stopped
+        """
+
+        self.length = self.base + os.fstat(self.index.fileno()).st_size // self.INDEX_RECORD.size
+        self.log_size = 0
+
+        size = os.fstat(self.log.fileno()).st_size
+        while self.length > self.base:
+            # The last indexed block is complete if its whole record made it to the log
+            offset = self.record(self.length - 1)[0]
+            if offset + FRAME.size <= size:
+                self.log.seek(offset)
+                end = offset + FRAME.size + FRAME.unpack(self.log.read(FRAME.size))[0]
+                if end <= size:
+                    self.log_size = end
+                    break
+            self.length -= 1
+
+        self.log.truncate(self.log_size)
+        self.index.truncate((self.length - self.base) * self.INDEX_RECORD.size)
+
+    def record(self, position):
+        """
+        :param position: <int> Position of the block in the chain
+        :return: <tuple> (offset in the log, raw hash)
+        """
+
+        self.index.seek((position - self.base) * self.INDEX_RECORD.size)
+        return self.INDEX_RECORD.unpack(self.index.read(self.INDEX_RECORD.size))
+
+    def read_checkpoint(self):
+        """
+        :return: <tuple> (number of verified blocks, hash of the last of them)
+        """
+
+        try:
+            with open(self.checkpoint_path) as checkpoint:
+                values = json.load(checkpoint)
+            return values['length'], values['hash']
+        except (OSError, ValueError, KeyError):
+            return 0, None
+
+    def load(self, start=0):
+        """
+        Read the stored blocks from a position on.
+        The log is mapped into memory rather than read through, each block is decoded
+        straight out of the mapping without copying its record, and the hashes
+        come from the index instead of being worked out again.
+        :param start: <int> Position of the first block to read, no earlier than base
+        :return: <list> Blocks
+        """
+
+        start = max(start, self.base)
+        if start >= self.length:
+            return []
+
+        self.log.flush()
+        self.index.flush()
+        self.index.seek((start - self.base) * self.INDEX_RECORD.size)
+        records = list(self.INDEX_RECORD.iter_unpack(self.index.read((self.length - start) * self.INDEX_RECORD.size)))
+
+        blocks = []
+        # Every view is released before the mapping closes, which it refuses to do while one is left
+        with mmap.mmap(self.log.fileno(), 0, access=mmap.ACCESS_READ) as log_map, memoryview(log_map) as log_view:
+            for position, (offset, raw_hash) in enumerate(records):
+                end = records[position + 1][0] if position + 1 < len(records) else self.log_size
+                with log_view[offset + FRAME.size:end] as record:
+                    blocks.append(Block.decode(record, raw_hash.hex()))
+
+        return blocks
+
+    def append(self, block):
+        """
+        Add a block to the end of the log, fsyncing every sync_every blocks
+        :param block: <Block>
+        """
+
+        self.log.seek(0, os.SEEK_END)
+        self.log.write(encode_frames([block.encode()]))
+        self.index.seek(0, os.SEEK_END)
+        self.index.write(self.INDEX_RECORD.pack(self.log_size, bytes.fromhex(block.hash)))
+        self.log_size = self.log.tell()
+        self.length += 1
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync(block)
+
+    def truncate(self, length):
+        """
+        Forget every block from position length onwards, when our chain is replaced
+        :param length: <int> Number of blocks to keep
+        """
+
+        length = max(length, self.base)
+        self.log.flush()
+        self.index.flush()
+        self.log_size = self.record(length)[0] if length < self.length else self.log_size
+        self.length = length
+        self.log.truncate(self.log_size)
+        self.index.truncate((length - self.base) * self.INDEX_RECORD.size)
+
+        # Never leave the checkpoint pointing past the end of the log
+        if self.read_checkpoint()[0] > length:
+            self.write_checkpoint(0, None)
+
+    def reset(self, base):
+        """
+        Empty the store, so that it starts again from position base
+        :param base: <int> Position of the first block that will be appended
+        """
+
+        self.truncate(self.base)
+        self.base = self.length = base
+        temporary_path = self.base_path + '.tmp'
+        with open(temporary_path, 'w') as saved:
+            json.dump(base, saved)
+            saved.flush()
+            os.fsync(saved.fileno())
+        os.replace(temporary_path, self.base_path)
+        self.write_checkpoint(0, None)
+
+    def sync(self, last_block):
+        """
+        Make everything appended so far durable and checkpoint it as verified
+        :param last_block: <Block> The last block in the store
+        """
+
+        self.log.flush()
+        self.index.flush()
+        os.fsync(self.log.fileno())
+        os.fsync(self.index.fileno())
+        self.unsynced = 0
+        self.write_checkpoint(self.length, last_block.hash)
+
+    def write_checkpoint(self, length, last_hash):
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint:
+            json.dump({'length': length, 'hash': last_hash}, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def read_snapshot(self):
+        """
+        :return: <dict> The latest snapshot, or None
+        """
+
+        try:
+            with open(self.snapshot_path) as snapshot:
+                return json.load(snapshot)
+        except (OSError, ValueError):
+            return None
+
+    def write_snapshot(self, snapshot):
+        # Only once the blocks it covers are durable, so it never describes blocks the log lost
+        temporary_path = self.snapshot_path + '.tmp'
+        with open(temporary_path, 'w') as saved:
+            json.dump(snapshot, saved)
+            saved.flush()
+            os.fsync(saved.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+
+# Seconds between stack samples, and the longest /debug/profile may sample for
+PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60
+
+# Upper bounds of the latency histograms' buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MINING_BUCKETS = (0.01, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+
+class Counter:
+    """
+    A Prometheus counter, optionally split by labels.
+    Each update takes a lock, cheap enough to leave on in the hot paths.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """
+    A Prometheus gauge: a value that is set rather than counted up
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Counter):
+    """
+    A Prometheus histogram of durations, with the count in each bucket, their sum and their number
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket and one past the last, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[position] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        # Observe how long the block takes, or the call when used as a decorator
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+
+        samples = []
+        for key, counts in values:
+            total = 0
+            for bound, in_bucket in zip(self.buckets + ('+Inf',), counts):
+                total += in_bucket
+                samples.append((f'{self.name}_bucket', key + (('le', bound),), total))
+            samples.append((f'{self.name}_sum', key, counts[-1]))
+            samples.append((f'{self.name}_count', key, total))
+
+        return samples
+
+
+class Metrics:
+    """
+    Everything the node measures about itself, rendered for /metrics in the Prometheus text format
+    """
 
-class Blockchain:
     def __init__(self):
-        self.current_transactions = []
+        self.mining_attempts = Counter(
+            'blocky_mining_attempts_total', 'Proof of work searches, by how they ended', ('result',))
+        self.mining_seconds = Histogram(
+            'blocky_mining_seconds', 'Time spent searching for a proof of work', buckets=MINING_BUCKETS)
+        self.hashes = Counter('blocky_hashes_total', 'Nonces up to each proof of work found')
+        self.hash_rate = Gauge('blocky_hash_rate', 'Hashes per second of the last proof of work found')
+        self.validations = Counter('blocky_chain_validations_total', 'valid_chain calls, by result', ('result',))
+        self.validated_blocks = Counter('blocky_validated_blocks_total', 'Blocks checked by valid_chain')
+        self.validation_seconds = Histogram('blocky_validation_seconds', 'Time valid_chain takes')
+        self.peer_fetches = Counter('blocky_peer_fetches_total', 'Chain fetches from peers, by result', ('result',))
+        self.peer_fetch_seconds = Histogram('blocky_peer_fetch_seconds', 'Time fetching and verifying a peer\'s chain')
+        self.consensus_seconds = Histogram('blocky_consensus_seconds', 'Time a resolve_conflicts round takes')
+        self.chain_replacements = Counter('blocky_chain_replacements_total', 'Times our chain was replaced')
+        self.signatures = Counter(
+            'blocky_signatures_total', 'Transaction signatures checked, by result, cached ones were verified before',
+            ('result',))
+        self.orphaned_transactions = Counter(
+            'blocky_orphaned_transactions_total', 'Transactions put back in the mempool when a reorg dropped their block')
+        self.side_blocks = Gauge('blocky_side_blocks', 'Blocks kept from branches off our chain')
+        self.transactions = Counter(
+            'blocky_transactions_submitted_total', 'Transactions submitted, by whether they were new', ('result',))
+        self.mempool_size = Gauge('blocky_mempool_transactions', 'Transactions waiting to be mined')
+        self.chain_length = Gauge('blocky_chain_length', 'Blocks in our chain')
+        self.chain_work = Gauge('blocky_chain_work', 'Expected hashes that went into our chain')
+        self.peers = Gauge('blocky_peers', 'Nodes we know of')
+        self.requests = Counter(
+            'blocky_http_requests_total', 'HTTP requests, by route, method and status', ('route', 'method', 'status'))
+        self.request_seconds = Histogram(
+            'blocky_http_request_seconds', 'Time handling an HTTP request, by route', ('route', 'method'))
+
+    def render(self):
+        """
+        :return: <str> Every metric in the Prometheus text exposition format
+        """
+
+        lines = []
+        for metric in vars(self).values():
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, key, value in metric.samples():
+                pairs = list(zip(metric.labels, key[:len(metric.labels)])) + list(key[len(metric.labels):])
+                labels = ','.join(f'{label}="{escape_label(text)}"' for label, text in pairs)
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    """
+    A sampling profiler: look at every other thread's stack every interval seconds.
+    Only this process is sampled, not the mining pool's workers.
+    :param seconds: <float> How long to sample for, on the calling thread
+    :param interval: <float> Seconds between samples
+    :return: <collections.Counter> Samples of each stack, in the collapsed
+             'thread;outermost;...;innermost' form flame graph tools read
+    """
+
+    stacks = Tally()
+    me = threading.get_ident()
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(stack))] += 1
+        sleep(interval)
+
+    return stacks
+
+
+class Blockchain:
+    def __init__(self, mining_workers=None, difficulty=DEFAULT_DIFFICULTY,
+                 target_block_time=TARGET_BLOCK_TIME, retarget_interval=RETARGET_INTERVAL, store=None,
+                 prune_depth=None, snapshot_interval=SNAPSHOT_INTERVAL, require_signatures=False):
+        self.mempool = Mempool()
         self.chain = []
         self.nodes = set()
 
-        # Create the genesis block
-        self.new_block(previous_hash='1', proof=100)
+        # Only writers take these locks. Blocks are only ever appended to self.chain, and
+        # consensus swaps in a new list rather than editing the old one, so readers never
+        # wait: the blocks a reader has seen stay put. Writers take chain_lock before mempool.lock.
+        self.chain_lock = threading.RLock()
+        self.nodes_lock = threading.Lock()
+
+        # (chain, length, total work) as of the last write, for readers that need all three to agree
+        self.head = ([], 0, 0)
+
+        # Callables told about each new tip, under the chain lock, so they must not block
+        self.watchers = []
+
+        # Where sealed blocks are kept on disk, if anywhere
+        self.store = store
+
+        # Branches off self.chain that may yet overtake it
+        self.tree = BlockTree()
+
+        # Transaction and address indexes over self.chain
+        self.ledger = Ledger()
+
+        self.mining_workers = mining_workers or os.cpu_count() or 1
+
+        # Mining and batch verification share these processes, started the first time they are needed
+        self.pool = WorkerPool(self.mining_workers)
+
+        # Proof of work expected to have gone into self.chain
+        self.total_work = 0
+
+        # When prune_depth is set, every snapshot_interval blocks the blocks more than prune_depth
+        # deep are settled into a snapshot, which consensus can no longer roll back. Only the
+        # blocks from horizon on are kept, enough to retarget the difficulty after the snapshot
+        # and to check the transaction windows of the blocks after it; the positions before it hold None.
+        if prune_depth is not None and prune_depth < 1:
+            raise ValueError('The prune depth must be at least one block')
+        self.prune_depth = prune_depth
+        self.snapshot_interval = snapshot_interval
+        self.snapshot = None
+        self.settled = 0
+        self.settled_work = 0
+        self.horizon = 0
+
+        # Ids of the settled transactions still inside the transaction window, worked out
+        # again each time our snapshot moves on: (settled length they were taken at, ids)
+        self.settled_txids = (0, frozenset())
+
+        # Keep-alive connections to our neighbours, shared by the consensus threads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_PEER_FETCHES)
+        self.session.mount('http://', adapter)
+
+        # Consensus parameters, every node on the network must agree on these
+        if not MIN_DIFFICULTY <= difficulty <= MAX_DIFFICULTY:
+            raise ValueError(f'The difficulty must be from {MIN_DIFFICULTY} to {MAX_DIFFICULTY} bits')
+        self.initial_difficulty = difficulty
+        self.target_block_time = target_block_time
+        self.retarget_interval = retarget_interval
+        self.require_signatures = require_signatures
+        if require_signatures and Ed25519PublicKey is None:
+            raise RuntimeError('Signed transactions need cryptography: pip install cryptography')
+
+        # Ids of transactions whose signatures checked out. An id covers the signature,
+        # so a transaction whose id is here has had its exact signature verified.
+        self.verified = OrderedDict()
+        self.verified_lock = threading.Lock()
+
+        if self.store is not None and len(self.store):
+            self.load_chain()
+        else:
+            # Create the genesis block
+            self.new_block(previous_hash='1', proof=100)
+
+    def load_chain(self):
+        """
+        Pick the chain back up from the block store.
+        Blocks up to the store's checkpoint were verified before they were written,
+        so only the ones after it are checked again. Anything after the checkpoint
+        that does not verify is dropped.
+        """
+
+        # A pruning node, or one bootstrapped from a snapshot, starts again from its latest snapshot
+        snapshot = self.store.read_snapshot()
+        if snapshot is not None and (self.prune_depth is not None or self.store.base):
+            self.settle(snapshot)
+        elif self.store.base:
+            raise ValueError('The block store starts past genesis, but holds no snapshot')
+
+        chain = [None] * self.horizon + self.store.load(self.horizon)
+        if self.settled and (len(chain) < self.settled or chain[self.settled - 1].hash != snapshot['hash']):
+            raise ValueError('The block store does not hold the blocks its snapshot covers')
+
+        length, last_hash = self.store.read_checkpoint()
+        if not max(self.settled, 1) <= length <= len(chain) or chain[length - 1].hash != last_hash:
+            length = max(self.settled, 1)
+
+        if not self.valid_chain(chain, length):
+            chain = chain[:length]
+            self.store.truncate(length)
+
+        self.chain = chain
+        self.total_work = self.settled_work + self.chain_work(chain[self.settled:])
+        if self.settled:
+            self.ledger = Ledger.from_snapshot(snapshot)
+            for position in range(self.settled, len(chain)):
+                self.ledger.add_block(chain[position], position)
+        else:
+            self.ledger = Ledger.load(self.ledger_path, chain)
+        self.publish()
+        self.store.sync(self.last_block)
+        self.prune()
+
+    def settle(self, snapshot):
+        """
+        Take a snapshot as the point consensus can no longer roll back past
+        :param snapshot: <dict>
+        """
+
+        self.snapshot = snapshot
+        self.settled = snapshot['length']
+        self.settled_work = snapshot['work']
+        self.horizon = self.horizon_of(self.settled)
+
+    def horizon_of(self, settled):
+        """
+        :param settled: <int> Length of the settled part of a chain
+        :return: <int> Position of the first block kept: enough blocks before the snapshot to
+                 retarget the difficulty after it, and to cover the transaction window of the
+                 blocks after it
+        """
+
+        return max(settled - max(self.retarget_interval + 1, TRANSACTION_WINDOW), 0)
+
+    def prune(self):
+        """
+        Every snapshot_interval blocks, settle the blocks more than prune_depth deep
+        into a new snapshot and let go of the ones before the horizon.
+        Called holding the chain lock.
+        """
+
+        if self.prune_depth is None:
+            return
+        settled = len(self.chain) - self.prune_depth
+        if settled < self.settled + self.snapshot_interval:
+            return
+
+        with self.mempool.lock:
+            for position in range(self.settled, settled):
+                block = self.chain[position]
+                self.ledger.prune_block(block)
+                self.settled_work += 1 << block.difficulty
+
+            last_block = self.chain[settled - 1]
+            self.settle({
+                'length': settled,
+                'hash': last_block.hash,
+                'header': last_block.header(),
+                'work': self.settled_work,
+                'balances': dict(self.ledger.settled_balances),
+                'transactions': dict(self.ledger.settled_counts),
+            })
+
+            # Copy on write, readers may still be going through the old list
+            self.chain = [None] * self.horizon + self.chain[self.horizon:]
+            self.head = (self.chain, len(self.chain), self.total_work)
+        self.tree.forget_before(settled)
+
+        if self.store is not None:
+            self.store.sync(self.last_block)
+            self.store.write_snapshot(self.snapshot)
+
+    def publish(self):
+        # Let readers see the chain as it now stands, and tell the watchers about its tip
+        self.head = (self.chain, len(self.chain), self.total_work)
+        for watcher in self.watchers:
+            watcher(self.chain[-1])
+
+    @property
+    def ledger_path(self):
+        return os.path.join(self.store.path, 'ledger.json')
+
+    def save(self):
+        """
+        Make the chain and its indexes durable, before the node shuts down
+        """
+
+        with self.chain_lock:
+            self.store.sync(self.last_block)
+            # A pruned chain starts again from its latest snapshot instead
+            if not self.settled:
+                self.ledger.save(self.ledger_path, self.chain)
 
     def register_node(self, address):
         """
@@ -25,113 +1998,651 @@ class Blockchain:
 
         parsed_url = urlparse(address)
         if parsed_url.netloc:
-            self.nodes.add(parsed_url.netloc)
+            node = parsed_url.netloc
         elif parsed_url.path:
             # Accepts an URL without scheme like '192.168.0.5:5000'.
-            self.nodes.add(parsed_url.path)
+            node = parsed_url.path
         else:
             raise ValueError('Invalid URL')
 
+        # Copy on write, so consensus can go through the nodes while others register
+        with self.nodes_lock:
+            self.nodes = self.nodes | {node}
 
-    def valid_chain(self, chain):
+        return node
+
+
+    @metrics.validation_seconds.time()
+    def valid_chain(self, chain, start=1, settled=None):
         """
-        Determine if a given blockchain is valid
+        Determine if a given blockchain is valid.
+        Blocks given as dicts are replaced in place by sealed Blocks as they are
+        checked, so their hashes are not worked out again.
         :param chain: A blockchain
+        :param start: <int> Position of the first block to check, the ones before it are trusted
+        :param settled: <int> Length of its settled part, defaults to ours. The transactions in the
+                        blocks from there to start are looked up in our ledger.
         :return: True if valid, False if not
         """
 
-        last_block = chain[0]
-        current_index = 1
+        valid = self.check_chain(chain, start, self.settled if settled is None else settled)
+        metrics.validations.inc(result='valid' if valid else 'invalid')
+        metrics.validated_blocks.inc(max(len(chain) - start, 0))
+        return valid
+
+    def check_chain(self, chain, start, settled):
+        # valid_chain, without the measuring
+        try:
+            last_block = chain[start - 1] = Block.from_dict(chain[start - 1])
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        # A transaction is mined once. Only blocks within the transaction window can hold it
+        # again: those our ledger indexes are looked up there, settled ones are gathered here.
+        seen = set()
+        for block in chain[max(start - TRANSACTION_WINDOW, 0):min(settled, start)]:
+            if block is not None:
+                seen.update(transaction.id for transaction in block.transactions)
+        latest = time() + MAX_CLOCK_DRIFT
+
+        proofs = []
+        for current_index in range(start, len(chain)):
+            try:
+                block = chain[current_index] = Block.from_dict(chain[current_index])
+            except (KeyError, TypeError, ValueError):
+                return False
+
+            # Check that the hash of the block is correct, and that it is numbered by its position
+            if block.previous_hash != last_block.hash or block.index != current_index + 1:
+                return False
 
-        while current_index < len(chain):
-            block = chain[current_index]
-            print(f'{last_block}')
-            print(f'{block}')
-            print("\n-----------\n")
-            # Check that the hash of the block is correct
-            last_block_hash = self.hash(last_block)
-            if block['previous_hash'] != last_block_hash:
+            # Check that time does not go backwards, the transaction window depends on it,
+            # and that the block is not dated ahead of the clocks of the nodes checking it
+            if not last_block.timestamp <= block.timestamp <= latest:
                 return False
 
-            # Check that the Proof of Work is correct
-            if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash):
+            # Check that the block claims the difficulty the chain requires of it
+            if block.difficulty != self.next_difficulty(chain, current_index):
                 return False
 
+            # Check that only the block's mining reward comes from nowhere, and no more than a reward
+            if self.require_signatures:
+                rewards = [transaction.amount for transaction in block.transactions if transaction.sender == "0"]
+                if len(rewards) > 1 or any(amount != MINING_REWARD for amount in rewards):
+                    return False
+
+            # Check that every transaction falls in the block's window and moves a positive amount,
+            # and that none is mined again, before its signature can be taken from the cache
+            after, until = self.transaction_window(chain, current_index, block.timestamp)
+            for transaction in block.transactions:
+                txid = transaction.id
+                if not after < transaction.timestamp <= until or not transaction.valid_amount() \
+                        or txid in seen or self.mined_before(chain, start, txid):
+                    return False
+                seen.add(txid)
+
+            proofs.append((last_block.proof, block.proof, last_block.hash, block.difficulty))
             last_block = block
-            current_index += 1
+
+        # Check that every Proof of Work is correct, all at once
+        if not all(verify_proofs(proofs, self.mining_workers, pool=self.pool)):
+            return False
+
+        # Check that every transaction is signed by its sender, also all at once
+        transactions = [(transaction, transaction.id)
+                        for block in chain[start:] for transaction in block.transactions]
+        return all(self.check_signatures(transactions))
+
+    @staticmethod
+    def transaction_window(chain, height, timestamp):
+        """
+        When the transactions in a block may have been made
+        :param chain: A blockchain
+        :param height: <int> Position of the block
+        :param timestamp: <float> The block's timestamp
+        :return: <tuple> (time its transactions must be newer than, time they must be no newer than)
+        """
+
+        after = chain[height - TRANSACTION_WINDOW].timestamp if height >= TRANSACTION_WINDOW else -math.inf
+        return after, timestamp
+
+    def mined_before(self, chain, start, txid):
+        """
+        :param chain: A blockchain sharing its blocks before start with ours
+        :param start: <int> Position of the first block not shared
+        :param txid: <str> Transaction id
+        :return: <bool> True if our ledger places the transaction in one of the shared blocks
+        """
+
+        location = self.ledger.transactions.get(txid)
+        if location is None or location[0] >= start:
+            return False
+
+        # The ledger may have moved on since chain was taken, so check the block really holds it
+        position, offset = location
+        if chain[position] is None:
+            return False
+        block = Block.from_dict(chain[position])
+        return offset < len(block.transactions) and block.transactions[offset].id == txid
+
+    def check_signatures(self, transactions):
+        """
+        Check the signatures of transactions, when the network requires them.
+        Only mining rewards, from "0", go unsigned. Transactions verified before are not
+        verified again, and the rest are verified in batches across mining_workers processes.
+        :param transactions: <list> (Transaction, id) pairs
+        :return: <list> True for each transaction that is signed by its sender or needs no signature
+        """
+
+        results = [True] * len(transactions)
+        if not self.require_signatures:
+            return results
+
+        pending = []
+        cached = 0
+        with self.verified_lock:
+            for position, (transaction, txid) in enumerate(transactions):
+                if transaction.sender == "0":
+                    continue
+                if txid in self.verified:
+                    cached += 1
+                    continue
+                signed = transaction.signed_message()
+                if signed is None:
+                    results[position] = False
+                else:
+                    pending.append((position, txid, signed))
+
+        valid = verify_signatures([signed for _, _, signed in pending], self.mining_workers,
+                                  pool=self.pool)
+        with self.verified_lock:
+            for (position, txid, _), signed_by_sender in zip(pending, valid):
+                results[position] = signed_by_sender
+                if signed_by_sender:
+                    self.verified[txid] = None
+            while len(self.verified) > VERIFIED_CACHE_SIZE:
+                self.verified.popitem(last=False)
+
+        metrics.signatures.inc(sum(valid), result='valid')
+        metrics.signatures.inc(cached, result='cached')
+        metrics.signatures.inc(results.count(False), result='invalid')
+        return results
+
+    def check_submissions(self, transactions):
+        """
+        :param transactions: <list> (Transaction, id) pairs submitted to the node
+        :return: <list> For each transaction, None if it may join the mempool, or what is wrong with it
+        """
+
+        latest = time() + MAX_CLOCK_DRIFT
+        errors = []
+        for (transaction, _), signed in zip(transactions, self.check_signatures(transactions)):
+            if not transaction.timestamp <= latest:
+                errors.append('Transaction is dated in the future')
+            elif not transaction.valid_amount():
+                errors.append('Amount must be a positive number')
+            elif self.require_signatures and transaction.sender == "0":
+                errors.append('Only mining rewards come from "0"')
+            elif not signed:
+                errors.append('Transaction is not signed by its sender')
+            else:
+                errors.append(None)
+
+        return errors
+
+    @staticmethod
+    def chain_work(chain):
+        """
+        Expected number of hashes it took to mine a list of blocks
+        :param chain: A list of blocks
+        :return: <int>
+        """
+
+        return sum(1 << block.difficulty for block in chain)
+
+    @metrics.peer_fetch_seconds.time()
+    def fetch_chain(self, node, min_work, session=None):
+        """
+        Download the blocks we are missing from a neighbour's chain and verify them,
+        if its chain has at least min_work.
+        The peer's head is checked first, so nothing else is downloaded when its tip is
+        one we already have or its chain has less work. After that only its last blocks
+        are fetched, from the shorter of the two tips, reaching further back while they
+        do not link to a block of ours or of a branch in our block tree, but never past
+        our latest snapshot.
+        A chain with no more work than min_work has its new blocks kept in the tree.
+        :param node: Address of the node. Eg. '192.168.0.5:5000'
+        :param min_work: <int> Work the chain has to beat
+        :param session: <requests.Session> To fetch with, defaults to our own
+        :return: <tuple> (chain, total work, number of blocks shared with ours) of a valid chain
+                 with more work, or None
+        """
+
+        session = session or self.session
+        try:
+            response = session.get(f'http://{node}/chain/head', timeout=PEER_TIMEOUT)
+            if response.status_code != 200:
+                metrics.peer_fetches.inc(result='failed')
+                return None
+            head = response.json()
+            ours, length, our_work = self.head
+            if head['hash'] == ours[length - 1].hash or head['hash'] in self.tree:
+                metrics.peer_fetches.inc(result='known')
+                return None
+            if head['work'] < min_work:
+                metrics.peer_fetches.inc(result='not_heavier')
+                return None
+
+            # With as much work or more, the peer's chain can still be no longer than ours
+            settled = self.settled
+            start = max(min(length, head['length'] - 1), 0)
+            # A chain that ends before our snapshot forks from before it too, and we no
+            # longer hold the blocks there to link it to
+            if start < settled:
+                metrics.peer_fetches.inc(result='too_deep')
+                return None
+            while True:
+                blocks = self.download_blocks(session, node, start)
+                if not blocks:
+                    metrics.peer_fetches.inc(result='failed')
+                    return None
+
+                # A block linking to one of ours means everything before it is ours too
+                if start == 0 or blocks[0].previous_hash == ours[start - 1].hash:
+                    shared, branch = start, []
+                    break
+
+                # As does one linking to a branch we already hold
+                found = self.tree.branch(blocks[0].previous_hash, ours, length)
+                if found is not None and found[0] + len(found[1]) == start:
+                    shared, branch = found
+                    break
+
+                # Forks from before our snapshot can no longer be followed
+                if start <= settled:
+                    metrics.peer_fetches.inc(result='too_deep')
+                    return None
+
+                # Double how far back we look each time
+                start = max(settled, length - max(1, 2 * (length - start)))
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            metrics.peer_fetches.inc(result='failed')
+            return None
+
+        if shared < settled:
+            metrics.peer_fetches.inc(result='too_deep')
+            return None
+
+        # Keep our own copy of the shared blocks and the branch, and check the rest. The branch is
+        # checked again too, none of its transactions are in our ledger to catch one mined twice.
+        chain = ours[:shared] + branch + blocks
+        if not self.valid_chain(chain, max(shared, 1)):
+            metrics.peer_fetches.inc(result='invalid')
+            return None
+
+        work = our_work - self.chain_work(ours[shared:length]) + self.chain_work(chain[shared:])
+        if work <= min_work:
+            self.tree.add(blocks)
+            metrics.peer_fetches.inc(result='not_heavier')
+            return None
+
+        metrics.peer_fetches.inc(result='heavier')
+        return chain, work, shared
+
+    @staticmethod
+    def download_blocks(session, node, start):
+        """
+        :param session: <requests.Session>
+        :param node: Address of the node. Eg. '192.168.0.5:5000'
+        :param start: <int> Position of the first block to download
+        :return: <list> The node's blocks from start to its tip, or None if it would not send them
+        :raises requests.RequestException, ValueError: If they could not be downloaded
+        """
+
+        response = session.get(
+            f'http://{node}/chain', params={'from': start + 1}, timeout=PEER_TIMEOUT,
+            headers={'Accept': f'{BINARY_MIMETYPE}, application/json;q=0.5'},
+        )
+        if response.status_code != 200:
+            return None
+        # Peers that predate the binary encoding answer in JSON
+        if response.headers.get('Content-Type', '').startswith(BINARY_MIMETYPE):
+            return [Block.decode(record) for record in decode_frames(response.content)]
+        return [Block.from_dict(block) for block in response.json()['chain']]
+
+    def bootstrap(self, node):
+        """
+        Start from a neighbour's latest snapshot and the blocks after it, instead of
+        downloading and replaying its chain from genesis.
+        The balances in the snapshot are taken on trust from the neighbour; the blocks
+        after it are verified as usual, and must lead back to the snapshot's block.
+        :param node: Address of the node. Eg. '192.168.0.5:5000'
+        :return: True if our chain was replaced, False if not
+        """
+
+        try:
+            response = self.session.get(f'http://{node}/snapshot', timeout=PEER_TIMEOUT)
+            if response.status_code != 200:
+                return False
+            values = response.json()
+            snapshot = {
+                'length': int(values['length']),
+                'hash': str(values['hash']),
+                'header': dict(values['header']),
+                'work': int(values['work']),
+                'balances': dict(values['balances']),
+                'transactions': dict(values['transactions']),
+            }
+            settled = snapshot['length']
+            horizon = self.horizon_of(settled)
+            blocks = self.download_blocks(self.session, node, horizon)
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return False
+
+        if not blocks or blocks[0].index != horizon + 1 or horizon + len(blocks) < settled:
+            return False
+
+        # The blocks before the snapshot's are only there to retarget the difficulty from
+        chain = [None] * horizon + blocks
+        for position in range(horizon + 1, settled):
+            if chain[position].previous_hash != chain[position - 1].hash:
+                return False
+        if chain[settled - 1].hash != snapshot['hash'] or not self.valid_chain(chain, settled, settled):
+            return False
+
+        ledger = Ledger.from_snapshot(snapshot)
+        for position in range(settled, len(chain)):
+            ledger.add_block(chain[position], position)
+
+        with self.chain_lock:
+            if len(chain) <= len(self.chain):
+                return False
+
+            with self.mempool.lock:
+                self.settle(snapshot)
+                self.ledger = ledger
+                self.chain = chain
+                self.total_work = self.settled_work + self.chain_work(chain[settled:])
+                self.publish()
+
+                for block in chain[settled:]:
+                    self.mempool.remove(transaction.id for transaction in block.transactions)
+
+            if self.store is not None:
+                self.store.reset(horizon)
+                for block in blocks:
+                    self.store.append(block)
+                self.store.sync(self.last_block)
+                self.store.write_snapshot(snapshot)
 
         return True
 
+    @metrics.consensus_seconds.time()
     def resolve_conflicts(self):
         """
         This is our consensus algorithm, it resolves conflicts
-        by replacing our chain with the longest one in the network.
+        by switching our chain to the one in the network with the most work.
+        Neighbours are polled concurrently, each chain being verified as it
+        arrives, and peers that miss the deadline are left out of the round.
+        Only the part of a chain that differs from ours is verified, and the
+        branches that lose are kept in the block tree.
         :return: True if our chain was replaced, False if not
         """
 
-        neighbours = self.nodes
+        neighbours = list(self.nodes)
         new_chain = None
+        new_work = None
+        shared = None
 
-        # We're only looking for chains longer than ours
-        max_length = len(self.chain)
+        # We're only looking for chains with more work than ours
+        max_work = self.head[2]
 
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
-
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
+        if not neighbours:
+            return False
 
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
-
-        # Replace our chain if we discovered a new, valid chain longer than ours
+        # Grab and verify the chains from all the nodes in our network
+        executor = ThreadPoolExecutor(max_workers=min(len(neighbours), MAX_PEER_FETCHES))
+        futures = [executor.submit(self.fetch_chain, node, max_work) for node in neighbours]
+        try:
+            for future in as_completed(futures, timeout=CONSENSUS_DEADLINE):
+                result = future.result()
+                if result is None:
+                    continue
+
+                # Check if the chain has the most work so far
+                if result[1] > max_work:
+                    if new_chain:
+                        self.tree.add(new_chain[shared:])
+                    new_chain, new_work, shared = result
+                    max_work = new_work
+                else:
+                    self.tree.add(result[0][result[2]:])
+        except TimeoutError:
+            pass
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Switch to the chain with the most work, if it is not ours
         if new_chain:
-            self.chain = new_chain
-            return True
+            return self.replace_chain(new_chain, new_work, shared) is not None
 
         return False
 
-    def new_block(self, proof, previous_hash):
+    def replace_chain(self, new_chain, new_work, shared):
         """
-        Create a new Block in the Blockchain
+        Reorganise onto a verified chain that forks from ours and has more work.
+        The indexes are rolled back to the fork point and forward along the new blocks,
+        the blocks dropped from our chain are kept in the block tree, and their
+        transactions that the new chain does not include go back to the mempool.
+        :param new_chain: <list> The chain, sharing its first blocks with ours
+        :param new_work: <int> Its total work
+        :param shared: <int> Number of blocks it shares with our chain
+        :return: <list> The blocks of ours it dropped, or None if our chain has moved on
+                 since new_chain was fetched and it no longer has more work, or no longer forks
+                 from ours after our latest snapshot
+        """
+
+        with self.chain_lock:
+            if (new_work <= self.total_work or shared < self.settled
+                    or (shared and self.chain[shared - 1] is not new_chain[shared - 1])):
+                # It may yet overtake ours
+                self.tree.add([
+                    block for block in new_chain[max(shared, self.settled):]
+                    if block.index > len(self.chain) or self.chain[block.index - 1] is not block
+                ])
+                return None
+            metrics.chain_replacements.inc()
+
+            dropped = self.chain[shared:]
+            with self.mempool.lock:
+                # Roll the indexes back to the fork point and forward along the new chain
+                for block in reversed(dropped):
+                    self.ledger.remove_block(block)
+                for position in range(shared, len(new_chain)):
+                    self.ledger.add_block(new_chain[position], position)
+
+                self.chain = new_chain
+                self.total_work = new_work
+                self.publish()
+
+                # Anything the new blocks include no longer needs mining, and anything else
+                # the dropped blocks held needs mining again, apart from their rewards
+                for block in new_chain[shared:]:
+                    self.mempool.remove(transaction.id for transaction in block.transactions)
+                orphaned = []
+                for block in dropped:
+                    for transaction in block.transactions:
+                        txid = transaction.id
+                        if transaction.sender != "0" and txid not in self.ledger.transactions \
+                                and not self.expired(transaction):
+                            orphaned.append((transaction, txid))
+                self.mempool.restore(orphaned)
+                metrics.orphaned_transactions.inc(len(orphaned))
+
+            self.tree.discard(new_chain[shared:])
+            self.tree.add(dropped)
+
+            if self.store is not None:
+                self.store.truncate(shared)
+                for block in new_chain[shared:]:
+                    self.store.append(block)
+                self.store.sync(self.last_block)
+            self.prune()
+
+        return dropped
+
+    def new_block(self, proof, previous_hash, difficulty=None, reward=None):
+        """
+        Create a new Block in the Blockchain, out of the transactions that have waited longest
         :param proof: The proof given by the Proof of Work algorithm
         :param previous_hash: Hash of previous Block
+        :param difficulty: Difficulty the proof was mined at, defaults to the one the chain requires next
+        :param reward: <Transaction> Reward for mining the block, always included
         :return: New Block
         """
 
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        }
-
-        # Reset the current list of transactions
-        self.current_transactions = []
-
-        self.chain.append(block)
-        return block
-
-    def new_transaction(self, sender, recipient, amount):
+        with self.chain_lock:
+            # Until the block is in the ledger, submissions must not see its transactions as unmined
+            with self.mempool.lock:
+                # Never before the last block, even if its miner's clock is ahead of ours
+                timestamp = max(time(), self.chain[-1].timestamp) if self.chain else time()
+                after, until = self.transaction_window(self.chain, len(self.chain), timestamp)
+                transactions = self.mempool.block_template(MAX_BLOCK_TRANSACTIONS - (reward is not None), after, until)
+                if reward is not None:
+                    transactions.append(reward)
+
+                block = Block(
+                    index=len(self.chain) + 1,
+                    timestamp=timestamp,
+                    transactions=transactions,
+                    proof=proof,
+                    previous_hash=previous_hash or self.hash(self.chain[-1]),
+                    difficulty=self.next_difficulty(self.chain) if difficulty is None else difficulty,
+                )
+
+                # Take the mined transactions out of the pool
+                self.mempool.remove(transaction.id for transaction in transactions)
+
+                self.chain.append(block)
+                self.total_work += 1 << block.difficulty
+                self.ledger.add_block(block, len(self.chain) - 1)
+                self.publish()
+
+            if self.store is not None:
+                self.store.append(block)
+            self.prune()
+            return block
+
+    def new_transaction(self, sender, recipient, amount, timestamp=None):
         """
         Creates a new transaction to go into the next mined Block
         :param sender: Address of the Sender
         :param recipient: Address of the Recipient
         :param amount: Amount
+        :param timestamp: When the transaction was made, defaults to now
+        :return: The index of the Block that will hold this transaction
+        """
+
+        return self.submit_transaction(Transaction(sender, recipient, amount, timestamp))
+
+    def submit_transaction(self, transaction, txid=None):
+        """
+        Add a transaction to the mempool, unless it is already waiting or already mined
+        :param transaction: <Transaction>
+        :param txid: <str> Its id, if already worked out
         :return: The index of the Block that will hold this transaction
+        :raises ValueError: If it is dated in the future, does not move a positive amount, or is not
+                            signed when the network requires it to be
+        """
+
+        txid = txid or transaction.id
+        error = self.check_submissions([(transaction, txid)])[0]
+        if error is not None:
+            metrics.transactions.inc(result='invalid')
+            raise ValueError(error)
+
+        if self.expired(transaction):
+            metrics.transactions.inc(result='expired')
+            return self.last_block.index + 1
+
+        with self.mempool.lock:
+            added = txid not in self.ledger.transactions and not self.recently_settled(txid) \
+                and self.mempool.add(transaction, txid)
+        metrics.transactions.inc(result='new' if added else 'known')
+
+        return self.last_block.index + 1
+
+    def submit_transactions(self, transactions):
+        """
+        Add many transactions to the mempool at once, leaving out any dated in the future,
+        not moving a positive amount, or not signed when the network requires them to be
+        :param transactions: <list> (Transaction, id) pairs
+        :return: The index of the Block that will hold the transactions
+        """
+
+        acceptable = [pair for pair, error in zip(transactions, self.check_submissions(transactions)) if error is None]
+        metrics.transactions.inc(len(transactions) - len(acceptable), result='invalid')
+        transactions = acceptable
+
+        fresh = [(transaction, txid) for transaction, txid in transactions if not self.expired(transaction)]
+        added = 0
+        with self.mempool.lock:
+            for transaction, txid in fresh:
+                if txid not in self.ledger.transactions and not self.recently_settled(txid):
+                    added += self.mempool.add(transaction, txid)
+        metrics.transactions.inc(added, result='new')
+        metrics.transactions.inc(len(fresh) - added, result='known')
+        metrics.transactions.inc(len(transactions) - len(fresh), result='expired')
+
+        return self.last_block.index + 1
+
+    def expired(self, transaction):
+        """
+        Transactions too old for the next block's window can no longer be mined, and are turned away
+        :param transaction: <Transaction>
+        :return: <bool>
+        """
+
+        chain, length, _ = self.head
+        after, _ = self.transaction_window(chain, length, None)
+        return transaction.timestamp <= after
+
+    def recently_settled(self, txid):
         """
-        self.current_transactions.append({
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount,
-        })
+        Settled transactions leave the ledger, but the newest ones could still go in
+        the next block, so submissions are checked against them too
+        :param txid: <str> Transaction id
+        :return: <bool> True if the transaction is in a settled block inside the transaction window
+        """
+
+        settled, txids = self.settled_txids
+        if settled != self.settled:
+            chain, settled = self.chain, self.settled
+            txids = frozenset(transaction.id for block in chain[max(settled - TRANSACTION_WINDOW, 0):settled]
+                              if block is not None for transaction in block.transactions)
+            self.settled_txids = (settled, txids)
+
+        return txid in txids
+
+    def find_transaction(self, txid):
+        """
+        :param txid: <str> Transaction id
+        :return: <tuple> (Block, position in it) holding the transaction, or None
+        """
+
+        location = self.ledger.transactions.get(txid)
+        if location is None:
+            return None
+
+        # The ledger is ahead of the chain while consensus switches over
+        chain, length, _ = self.head
+        position, offset = location
+        if position >= length or chain[position] is None or offset >= len(chain[position].transactions):
+            return None
+        if chain[position].transactions[offset].id != txid:
+            return None
 
-        return self.last_block['index'] + 1
+        return chain[position], offset
 
     @property
     def last_block(self):
@@ -144,46 +2655,123 @@ class Blockchain:
         :param block: Block
         """
 
-        # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        # Sealed blocks already know their hash, plain dicts are sealed first
+        return Block.from_dict(block).hash
 
-    def proof_of_work(self, last_block):
+    def next_difficulty(self, chain, height=None):
+        """
+        Difficulty required of the block that follows the first height blocks of a chain.
+        Every retarget_interval blocks it moves towards target_block_time, based on how
+        long the previous retarget_interval blocks took to mine.
+        :param chain: A blockchain
+        :param height: <int> Number of blocks before the new one, defaults to the whole chain
+        :return: <int>
+        """
+
+        if height is None:
+            height = len(chain)
+
+        if height == 0:
+            return self.initial_difficulty
+
+        last_block = chain[height - 1]
+        if height % self.retarget_interval != 0 or height <= self.retarget_interval:
+            return last_block.difficulty
+
+        first_block = chain[height - 1 - self.retarget_interval]
+        actual_time = max(last_block.timestamp - first_block.timestamp, 1e-6)
+        expected_time = self.retarget_interval * self.target_block_time
+
+        # Each bit of difficulty doubles the expected work
+        step = round(math.log2(expected_time / actual_time))
+        step = max(-MAX_RETARGET_STEP, min(MAX_RETARGET_STEP, step))
+        return max(MIN_DIFFICULTY, min(MAX_DIFFICULTY, last_block.difficulty + step))
+
+    def proof_of_work(self, last_block, difficulty=None, cancelled=None):
         """
         Simple Proof of Work Algorithm:
-         - Find a number p' such that hash(pp') contains leading 4 zeroes
+         - Find a number p' such that hash(pp') starts with difficulty zero bits
          - Where p is the previous proof, and p' is the new proof
+         - The search is split across mining_workers processes when there is more than one
          
-        :param last_block: <dict> last Block
-        :return: <int>
+        :param last_block: <Block> last Block
+        :param difficulty: <int> Defaults to the difficulty the chain requires next
+        :param cancelled: Callable returning True once the search should be abandoned
+        :return: <int> The proof, or None if the search was cancelled
         """
 
-        last_proof = last_block['proof']
+        last_proof = last_block.proof
         last_hash = self.hash(last_block)
+        if difficulty is None:
+            difficulty = self.next_difficulty(self.chain)
+        target = proof_target(difficulty)
+
+        if self.mining_workers > 1:
+            return parallel_proof_of_work(last_proof, last_hash, self.mining_workers, target=target,
+                                          cancelled=cancelled, pool=self.pool)
 
-        proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
-            proof += 1
+        return find_proof(last_proof, last_hash, target=target, cancelled=cancelled)
 
-        return proof
+    def mine(self, reward_address, cancelled=None):
+        """
+        Mine the next block on top of our chain
+        :param reward_address: Address that receives the mining reward
+        :param cancelled: Callable returning True once mining should be abandoned
+        :return: <Block> The new block, or None if mining was cancelled or our tip moved on meanwhile
+        """
+
+        # We run the proof of work algorithm to get the next proof...
+        last_block = self.last_block
+        difficulty = self.next_difficulty(self.chain)
+        start = perf_counter()
+        proof = self.proof_of_work(last_block, difficulty, cancelled)
+        seconds = perf_counter() - start
+        metrics.mining_seconds.observe(seconds)
+        if proof is None:
+            metrics.mining_attempts.inc(result='cancelled')
+            return None
+
+        # Proofs are searched from 0 up, so the proof is about how many hashes it took
+        metrics.hashes.inc(proof + 1)
+        metrics.hash_rate.set((proof + 1) / max(seconds, 1e-9))
+
+        # We must receive a reward for finding the proof.
+        # The sender is "0" to signify that this node has mined a new coin.
+        reward = Transaction(
+            sender="0",
+            recipient=reward_address,
+            amount=MINING_REWARD,
+        )
+
+        # Forge the new Block by adding it to the chain
+        with self.chain_lock:
+            if self.last_block is not last_block:
+                metrics.mining_attempts.inc(result='stale')
+                return None
+
+            metrics.mining_attempts.inc(result='mined')
+            previous_hash = self.hash(last_block)
+            return self.new_block(proof, previous_hash, difficulty, reward)
 
     @staticmethod
-    def valid_proof(last_proof, proof, last_hash):
+    def valid_proof(last_proof, proof, last_hash, difficulty=DEFAULT_DIFFICULTY):
         """
         Validates the Proof
         :param last_proof: <int> Previous Proof
         :param proof: <int> Current Proof
         :param last_hash: <str> The hash of the Previous Block
+        :param difficulty: <int> Number of leading zero bits the hash needs
         :return: <bool> True if correct, False if not.
         """
 
         guess = f'{last_proof}{proof}{last_hash}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        guess_hash = hashlib.sha256(guess).digest()
+        return guess_hash < proof_target(difficulty)
 
 
 # Instantiate the Node
 app = Flask(__name__)
+app.json = BlockJSONProvider(app)
 
 # Generate a globally unique address for this node
 node_identifier = str(uuid4()).replace('-', '')
@@ -191,31 +2779,93 @@ node_identifier = str(uuid4()).replace('-', '')
 # Instantiate the Blockchain
 blockchain = Blockchain()
 
+# Mines in the background between /mine/start and /mine/stop
+miner = Miner(blockchain, node_identifier)
+gossip = Gossip(blockchain, 5000)
+
 
 @app.route('/mine', methods=['GET'])
 def mine():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    proof = blockchain.proof_of_work(last_block)
-
-    # We must receive a reward for finding the proof.
-    # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction(
-        sender="0",
-        recipient=node_identifier,
-        amount=1,
-    )
-
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
+    block = blockchain.mine(node_identifier)
+    if block is None:
+        return 'Our chain was replaced while mining, try again', 409
 
     response = {
         'message': "New Block Forged",
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'proof': block['proof'],
-        'previous_hash': block['previous_hash'],
+        'index': block.index,
+        'transactions': block.transactions,
+        'proof': block.proof,
+        'previous_hash': block.previous_hash,
+        'difficulty': block.difficulty,
+    }
+    return jsonify(response), 200
+
+
+def transaction_from_values(values):
+    """
+    Build a Transaction from POST'ed data
+    :param values: <dict> The transaction's fields
+    :return: <Transaction>
+    """
+
+    # Check that the required fields are in the POST'ed data
+    required = ['sender', 'recipient', 'amount']
+    if not isinstance(values, dict) or not all(k in values for k in required):
+        raise ValueError('Missing values')
+
+    if isinstance(values['amount'], bool):
+        raise ValueError('Amount must be a number')
+
+    signature = values.get('signature')
+    if signature is not None:
+        if not isinstance(signature, str):
+            raise ValueError('Signature must be hex')
+        signature = bytes.fromhex(signature)
+
+    # Anything the binary encoding cannot hold could never be given an id
+    transaction = Transaction(values['sender'], values['recipient'], values['amount'], values.get('timestamp'),
+                              signature)
+    transaction.encode()
+    return transaction
+
+
+def transaction_from_bytes(data):
+    """
+    Build a Transaction from one binary encoded record
+    :param data: <bytes> The record
+    :return: <Transaction>
+    """
+
+    transaction, end = Transaction.decode(data)
+    if end != len(data):
+        raise ValueError('Trailing bytes after transaction')
+
+    return transaction
+
+
+@app.route('/mine/start', methods=['POST'])
+def start_mining():
+    started = miner.start()
+
+    response = {
+        'message': 'Mining started' if started else 'Already mining',
+        **miner.status(),
+    }
+    return jsonify(response), 202 if started else 200
+
+
+@app.route('/mine/status', methods=['GET'])
+def mining_status():
+    return jsonify(miner.status()), 200
+
+
+@app.route('/mine/stop', methods=['POST'])
+def stop_mining():
+    stopped = miner.stop()
+
+    response = {
+        'message': 'Mining stopped' if stopped else 'Not mining',
+        **miner.status(),
     }
     return jsonify(response), 200
 
@@ -224,27 +2874,225 @@ def mine():
 def new_transaction():
     values = request.get_json(force=True)
 
-    # Check that the required fields are in the POST'ed data
-    required = ['sender', 'recipient', 'amount']
-    if not all(k in values for k in required):
-        return 'Missing values', 400
+    try:
+        transaction = transaction_from_values(values)
+    except ValueError as error:
+        return str(error), 400
 
     # Create a new Transaction
-    index = blockchain.new_transaction(values['sender'], values['recipient'], values['amount'])
+    txid = transaction.id
+    try:
+        index = blockchain.submit_transaction(transaction, txid)
+    except ValueError as error:
+        return str(error), 400
+    gossip.announce_transactions([txid])
+
+    response = {
+        'message': f'Transaction will be added to Block {index}',
+        'id': txid,
+    }
+    return jsonify(response), 201
+
+
+@app.route('/transactions/batch', methods=['POST'])
+def new_transactions():
+    # A JSON array of transactions, NDJSON with one transaction per line, or length-prefixed binary records
+    ndjson = request.mimetype == 'application/x-ndjson'
+    binary = request.mimetype == BINARY_MIMETYPE
+    if ndjson:
+        entries = (line for line in io.BufferedReader(request.stream) if line.strip())
+    elif binary:
+        try:
+            entries = list(decode_frames(request.get_data()))
+        except ValueError as error:
+            return f'Error: {error}', 400
+    else:
+        entries = request.get_json(force=True)
+        if not isinstance(entries, list):
+            return 'Error: Please supply a list of transactions', 400
+
+    # Every entry gets a result, in order: the transaction's id or what was wrong with it
+    results = []
+    accepted = []
+    for entry in entries:
+        try:
+            if binary:
+                transaction = transaction_from_bytes(entry)
+            else:
+                transaction = transaction_from_values(json.loads(entry) if ndjson else entry)
+        except ValueError as error:
+            results.append({'error': str(error)})
+            continue
+
+        txid = transaction.id
+        accepted.append((len(results), transaction, txid))
+        results.append({'id': txid})
+
+    # Signatures are verified for the whole batch at once
+    errors = blockchain.check_submissions([(transaction, txid) for _, transaction, txid in accepted])
+    for (position, _, _), error in zip(accepted, errors):
+        if error is not None:
+            results[position] = {'error': error}
+    accepted = [(transaction, txid) for (_, transaction, txid), error in zip(accepted, errors) if error is None]
+
+    index = blockchain.submit_transactions(accepted)
+    gossip.announce_transactions([txid for _, txid in accepted])
 
-    response = {'message': f'Transaction will be added to Block {index}'}
+    response = {
+        'message': f'{len(accepted)} transactions will be added to Block {index}',
+        'results': results,
+    }
     return jsonify(response), 201
 
 
+@app.route('/transactions/<txid>', methods=['GET'])
+def get_transaction(txid):
+    found = blockchain.find_transaction(txid)
+    if found is None:
+        # Still waiting to be mined
+        transaction = blockchain.mempool.transactions.get(txid)
+        if transaction is None:
+            return 'Unknown transaction', 404
+        return jsonify({'transaction': transaction, 'block': None, 'position': None}), 200
+
+    block, offset = found
+    response = {
+        'transaction': block.transactions[offset],
+        'block': block.index,
+        'position': offset,
+    }
+    return jsonify(response), 200
+
+
+@app.route('/transactions/<txid>/proof', methods=['GET'])
+def transaction_proof(txid):
+    found = blockchain.find_transaction(txid)
+    if found is None:
+        return 'Unknown transaction', 404
+
+    # Enough to check the transaction is in the block against its header alone
+    block, offset = found
+    response = {
+        'id': txid,
+        'block': block.index,
+        'block_hash': block.hash,
+        'merkle_root': block.merkle_root,
+        'proof': merkle_proof(block.txids(), offset),
+    }
+    return jsonify(response), 200
+
+
+@app.route('/address/<address>/balance', methods=['GET'])
+def address_balance(address):
+    response = {
+        'address': address,
+        'balance': blockchain.ledger.balances.get(address, 0),
+        'transactions': blockchain.ledger.count(address),
+    }
+    return jsonify(response), 200
+
+
+def stream_blocks(chain, start, stop):
+    # One JSON block per line, encoded as it is sent
+    for position in range(start, stop):
+        yield app.json.dumps(chain[position]) + '\n'
+
+
+def stream_frames(chain, start, stop):
+    # Length-prefixed binary blocks, encoded as they are sent
+    for position in range(start, stop):
+        yield encode_frames([chain[position].encode()])
+
+
+def stream_chain(chain, start, stop, extra):
+    # The same document as a plain /chain response, encoded a block at a time
+    yield '{"chain":['
+    for position in range(start, stop):
+        yield (',' if position > start else '') + app.json.dumps(chain[position])
+    yield '],' + app.json.dumps(extra)[1:]
+
+
 @app.route('/chain', methods=['GET'])
 def full_chain():
+    # Hold on to the current list, so a page or stream is a consistent snapshot
+    # even if consensus replaces the chain or a block is mined meanwhile
+    chain, length, _ = blockchain.head
+
+    # Peers that already have part of our chain only ask for the blocks from an index on,
+    # and explorers walk the chain a page at a time. A pruned chain starts at its horizon.
+    horizon = blockchain.horizon
+    start = max(request.args.get('from', horizon + 1, type=int), 1) - 1
+    if start < horizon:
+        return f'Blocks before {horizon + 1} have been pruned', 410
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        # An empty page would point its next cursor back at itself
+        return 'Error: limit must be at least 1', 400
+    stop = length if limit is None else min(length, start + min(limit, MAX_CHAIN_PAGE))
+
+    extra = {'length': length}
+    if limit is not None:
+        # Index to ask for the next page from, None on the last page
+        extra['next'] = stop + 1 if stop < length else None
+
+    # Peers that can take the binary encoding ask for it in their Accept header
+    if request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE:
+        headers = {'X-Chain-Length': str(length)}
+        if extra.get('next'):
+            headers['X-Chain-Next'] = str(extra['next'])
+        return Response(stream_frames(chain, start, stop), mimetype=BINARY_MIMETYPE, headers=headers)
+
+    stream = request.args.get('stream')
+    if stream == 'ndjson':
+        return Response(stream_blocks(chain, start, stop), mimetype='application/x-ndjson',
+                        headers={'X-Chain-Length': str(length)})
+    if stream == 'json':
+        return Response(stream_chain(chain, start, stop, extra), mimetype='application/json')
+
+    response = {
+        'chain': chain[start:stop],
+        **extra,
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/head', methods=['GET'])
+def chain_head():
+    chain, length, work = blockchain.head
     response = {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain),
+        'length': length,
+        'hash': chain[length - 1].hash,
+        'work': work,
     }
     return jsonify(response), 200
 
 
+@app.route('/snapshot', methods=['GET'])
+def latest_snapshot():
+    snapshot = blockchain.snapshot
+    if snapshot is None:
+        return 'No snapshot has been taken', 404
+
+    return jsonify(snapshot), 200
+
+
+@app.route('/inv', methods=['POST'])
+def inventory():
+    values = request.get_json(force=True)
+
+    try:
+        wanted = gossip.receive(values, request.remote_addr)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return 'Error: Not an inventory message', 400
+
+    return jsonify({'transactions': wanted}), 200
+
+
+@app.route('/gossip/status', methods=['GET'])
+def gossip_status():
+    return jsonify(gossip.status()), 200
+
+
 @app.route('/nodes/register', methods=['POST'])
 def register_nodes():
     values = request.get_json()
@@ -263,22 +3111,208 @@ def register_nodes():
     return jsonify(response), 201
 
 
+@app.before_request
+def start_timer():
+    g.started = perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Streamed responses are timed up to their first byte
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.request_seconds.observe(perf_counter() - g.started, route=route, method=request.method)
+    metrics.requests.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Gauges are read off the node as it is scraped
+    _, length, work = blockchain.head
+    metrics.chain_length.set(length)
+    metrics.chain_work.set(work)
+    metrics.mempool_size.set(len(blockchain.mempool))
+    metrics.peers.set(len(blockchain.nodes))
+    metrics.side_blocks.set(len(blockchain.tree))
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/debug/profile', methods=['GET'])
+def profile():
+    # Off unless the node was started with --profiling
+    if not app.config.get('PROFILING'):
+        return 'Profiling is not enabled', 404
+
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0), MAX_PROFILE_SECONDS)
+    interval = max(request.args.get('interval', PROFILE_INTERVAL, type=float), 0.001)
+    stacks = sample_stacks(seconds, interval)
+
+    return Response(''.join(f'{stack} {samples}\n' for stack, samples in stacks.most_common()), mimetype='text/plain')
+
+
 @app.route('/nodes/resolve', methods=['GET'])
 def consensus():
     replaced = blockchain.resolve_conflicts()
 
-    if replaced:
-        response = {
-            'message': 'Our chain was replaced',
-            'new_chain': blockchain.chain
-        }
-    else:
-        response = {
-            'message': 'Our chain is authoritative',
-            'chain': blockchain.chain
+    # Only the head, the chain itself is a /chain request away
+    chain, length, work = blockchain.head
+    response = {
+        'message': 'Our chain was replaced' if replaced else 'Our chain is authoritative',
+        'length': length,
+        'hash': chain[length - 1].hash,
+        'work': work,
+    }
+    return jsonify(response), 200
+
+
+class AsyncNode:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        """
+        An ASGI application serving a WSGI app from a thread pool, so the event loop keeps
+        accepting connections while views run and long responses stream out
+
+        :param wsgi_app: The Flask app, or any WSGI callable
+        :param threads: <int> Requests handled at once
+        """
+
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['type'] != 'http':
+            return
+
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        loop = asyncio.get_running_loop()
+        status, headers, chunks, result = await loop.run_in_executor(
+            self.executor, self.start_response, self.environ(scope, bytes(body))
+        )
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+
+        try:
+            while True:
+                # Generators like /chain?stream=ndjson serialize on a worker thread too
+                chunk = await loop.run_in_executor(self.executor, self.read_body, chunks)
+                if not chunk:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+
+    @staticmethod
+    def environ(scope, body):
+        """
+        The WSGI environ for an ASGI http scope
+
+        :param scope: <dict> ASGI connection scope
+        :param body: <bytes> The whole request body
+        :return: <dict>
+        """
+
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
         }
 
-    return jsonify(response), 200
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f'HTTP_{name}'
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+        return environ
+
+    def start_response(self, environ):
+        """
+        Call the WSGI app on a worker thread
+
+        :param environ: <dict>
+        :return: <tuple> (status code, ASGI headers, iterator over the body, the app's iterable)
+        """
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        result = self.wsgi_app(environ, start_response)
+        chunks = iter(result)
+        # WSGI apps may put off start_response until the first chunk
+        first = next(chunks, b'')
+        return started['status'], started['headers'], chain([first], chunks), result
+
+    @staticmethod
+    def read_body(chunks):
+        """
+        Up to ASGI_SEND_SIZE bytes of the response body, or b'' once it is exhausted
+
+        :param chunks: Iterator over the body
+        :return: <bytes>
+        """
+
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= ASGI_SEND_SIZE:
+                break
+
+        return bytes(buffer)
+
+
+def serve_async(port, threads=ASGI_THREADS):
+    """
+    Serve the node under uvicorn rather than Flask's development server
+
+    :param port: <int>
+    :param threads: <int> Requests handled at once
+    """
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('--server asgi needs uvicorn: pip install uvicorn')
+
+    uvicorn.run(AsyncNode(app, threads), host='0.0.0.0', port=port, log_level='warning')
 
 
 if __name__ == '__main__':
@@ -286,7 +3320,53 @@ if __name__ == '__main__':
 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='mining processes (default: one per CPU)')
+    parser.add_argument('-d', '--difficulty', default=DEFAULT_DIFFICULTY, type=int, help='initial difficulty in leading zero bits')
+    parser.add_argument('--block-time', default=TARGET_BLOCK_TIME, type=float, help='target seconds per block')
+    parser.add_argument('--retarget-interval', default=RETARGET_INTERVAL, type=int, help='blocks between difficulty adjustments')
+    parser.add_argument('--data-dir', default=None, help='directory to keep the chain in across restarts')
+    parser.add_argument('--server', default='flask', choices=['flask', 'asgi'], help='serve with Flask, or asynchronously under uvicorn')
+    parser.add_argument('--threads', default=ASGI_THREADS, type=int, help='requests the asgi server handles at once')
+    parser.add_argument('--profiling', action='store_true', help='serve /debug/profile, a sampling profiler')
+    parser.add_argument('--prune-depth', default=None, type=int, help='settle blocks this deep into snapshots and let go of them (default: keep every block)')
+    parser.add_argument('--snapshot-interval', default=SNAPSHOT_INTERVAL, type=int, help='blocks between snapshots when pruning')
+    parser.add_argument('--bootstrap', default=None, help='start from the latest snapshot of this node, eg. 192.168.0.5:5000')
+    parser.add_argument('--signed', action='store_true', help='require transactions to be signed by their senders')
+    parser.add_argument('--reward-address', default=None, help='address mining rewards go to (default: the node identifier)')
     args = parser.parse_args()
     port = args.port
 
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    store = BlockStore(args.data_dir) if args.data_dir else None
+
+    blockchain = Blockchain(
+        mining_workers=args.workers,
+        difficulty=args.difficulty,
+        target_block_time=args.block_time,
+        retarget_interval=args.retarget_interval,
+        store=store,
+        prune_depth=args.prune_depth,
+        snapshot_interval=args.snapshot_interval,
+        require_signatures=args.signed,
+    )
+    if args.reward_address:
+        node_identifier = args.reward_address
+    miner = Miner(blockchain, node_identifier)
+    gossip = Gossip(blockchain, port)
+
+    # Only a node that is starting out, a restarted one picks up from its own chain
+    if args.bootstrap and len(blockchain.chain) == 1:
+        if not blockchain.bootstrap(blockchain.register_node(args.bootstrap)):
+            raise SystemExit(f'Could not bootstrap from {args.bootstrap}')
+
+    # The worker processes shared by mining and verification
+    atexit.register(blockchain.pool.close)
+    if store is not None:
+        # Blocks still waiting for a batched fsync, and the indexes
+        atexit.register(blockchain.save)
+
+    app.config['PROFILING'] = args.profiling
+
+    if args.server == 'asgi':
+        serve_async(port, args.threads)
+    else:
+        app.run(host='0.0.0.0', port=port)
\ No newline at end of file